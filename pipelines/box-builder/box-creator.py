@@ -3,92 +3,43 @@ import requests
 import time
 import json
 import re
-
-def get_cluster_query_output(cluster_query, proxmox_ip, token_name, token_secret):
-    api_url = f"https://{proxmox_ip}:8006/{cluster_query}"
-    headers = {
-        "Authorization": f"PVEAPIToken={token_name}={token_secret}"
-    }
-    
-    response = requests.get(api_url, headers=headers, verify=False)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        response.raise_for_status()
-
-def delete_cluster_query(cluster_query, proxmox_ip, token_name, token_secret):
-    api_url = f"https://{proxmox_ip}:8006/{cluster_query}"
-    headers = {
-        "Authorization": f"PVEAPIToken={token_name}={token_secret}"
-    }
-
-    response = requests.delete(api_url, headers=headers, verify=False)
-    
-    if response.status_code in (200, 204):
-        return response.json() if response.content else "Deletion successful"
-    else:
-        response.raise_for_status()
-
-def post_cluster_query(cluster_query, data, proxmox_ip, token_name, token_secret):
-    api_url = f"https://{proxmox_ip}:8006/{cluster_query}"
-    headers = {
-        "Authorization": f"PVEAPIToken={token_name}={token_secret}"
-    }
-
-    if data:
-        response = requests.post(api_url, headers=headers, data=data, verify=False)
-    else:
-        response = requests.post(api_url, headers=headers, verify=False)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        response.raise_for_status()
-
-def put_cluster_query(cluster_query, data, proxmox_ip, token_name, token_secret):
-    api_url = f"https://{proxmox_ip}:8006/{cluster_query}"
-    headers = {
-        "Authorization": f"PVEAPIToken={token_name}={token_secret}"
-    }
-
-    response = requests.put(api_url, headers=headers, data=data, verify=False)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        response.raise_for_status()
-
-def get_vm_metadata(proxmox_ip, token_name, token_secret):
-    vm_data = {}
-    vmids = get_cluster_query_output("api2/json/cluster/resources", proxmox_ip, token_name, token_secret)["data"]
-    for vm in vmids:
-        if vm["type"] == "qemu":
-            vm_data[vm["vmid"]] = {}
-            vm_data[vm["vmid"]]["proxmox_node"] = vm["node"]
-            vm_data[vm["vmid"]]["status"] = vm["status"]
-    return vm_data
-
-def pick_vmid(proxmox_ip, token_name, token_secret, vmid_start, vmid_end):
-    vmid_start = int(vmid_start)
-    vmid_end = int(vmid_end)
-    vm_metadata = get_vm_metadata(proxmox_ip, token_name, token_secret)
-    used_vmids = vm_metadata.keys()
-    for vmid in range(vmid_start, vmid_end + 1):
-        if vmid not in used_vmids:
-            return vmid
-    raise ValueError("No available VMID found in the specified range")
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from proxmox_api import get_cluster_query_output, post_cluster_query, put_cluster_query
+from proxmox_tasks import backoff_intervals, wait_for_task
+from cluster_resources import get_cluster_snapshot, newest_template
+from vmid_allocator import allocate_vmid
+from placement import NodePlacer
+from timing import print_summary, record, span, write_prometheus, write_report
+from warm_pool import claim_warm_vm, current_templates, discard_warm_vm, load_targets, stale_warm_vms, warm_deficit, warm_source_tag, warm_tag, warm_vm_name
+
+# Storage clones land on (the one template-creator imports to); auto placement checks its headroom
+BOX_STORAGE = "local-lvm"
+# Guest agent polling starts fast and backs off; most agents answer within seconds of boot
+IP_POLL_INITIAL = 0.5
+IP_POLL_MAX = 5.0
 
 def find_template(proxmox_ip, proxmox_node, token_name, token_secret, template_name):
-    cluster_query = f"api2/json/nodes/{proxmox_node}/qemu"
-    vms = get_cluster_query_output(cluster_query, proxmox_ip, token_name, token_secret)
-    for vm in vms['data']:
-        if vm['name'] == template_name and vm.get('template', 0) == 1:
-            return vm['vmid']
-    
-    return None
-
-def clone_template(proxmox_ip, proxmox_node, token_name, token_secret, template_vmid, vm_id, vm_name, pool):
+    vm = newest_template(proxmox_ip, token_name, token_secret, template_name, proxmox_node)
+    return vm['vmid'] if vm else None
+
+def find_template_nodes(proxmox_ip, token_name, token_secret, template_name):
+    # Node -> template VMID for every node holding a copy; a clone has to run where the template's disk is
+    return current_templates(proxmox_ip, token_name, token_secret, template_name)
+
+def place_box(proxmox_ip, token_name, token_secret, placer, template_name, vm_name, vm_cores, vm_memory, vm_storage):
+    # Returns (node, template VMID on that node) for the least loaded node that has the template
+    template_nodes = find_template_nodes(proxmox_ip, token_name, token_secret, template_name)
+    if not template_nodes:
+        print(f"Critical failure, could not find {template_name} on any node, aborting")
+        raise SystemExit(1)
+    proxmox_node = placer.choose(vm_name, int(vm_cores), int(vm_memory) * 1024 ** 2, int(vm_storage) * 1024 ** 3, candidates=template_nodes)
+    return proxmox_node, template_nodes[proxmox_node]
+
+def clone_template(proxmox_ip, proxmox_node, token_name, token_secret, template_vmid, vm_id, vm_name, pool=None):
     cluster_query = f"api2/json/nodes/{proxmox_node}/qemu/{template_vmid}/clone"
     data = {
         "newid": vm_id,
@@ -96,8 +47,10 @@ def clone_template(proxmox_ip, proxmox_node, token_name, token_secret, template_
         "pool": pool
     }
     response = post_cluster_query(cluster_query, data, proxmox_ip, token_name, token_secret)
-    
-    return response
+    # Waited for here, inside allocate_vmid's reserve, so a clone task that fails because the VMID
+    # was taken meanwhile is retried with the next free one
+    wait_for_task(proxmox_ip, token_name, token_secret, response)
+    return response["data"]
 
 def check_pool(proxmox_ip, token_name, token_secret, pool_name):
     # check if pool exists already
@@ -130,20 +83,32 @@ def ensure_resource_pool(proxmox_ip, token_name, token_secret, pool_name):
     if not exists:
         create_pool(proxmox_ip, token_name, token_secret, pool_name)    
 
-def configure_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid, cores, memory, network):
+def set_vm_resource_pool(proxmox_ip, token_name, token_secret, resource_pool, vmid):
+    endpoint = f"api2/json/pools"
+    data={}
+    data["poolid"]=resource_pool
+    data["vms"]=vmid
+    data["allow-move"]="1"
+    put_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret)
+
+def configure_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid, cores, memory, network, name=None):
     endpoint=f"api2/json/nodes/{proxmox_node}/qemu/{vmid}/config"
     data={}
+    if name:
+        data["name"]=name
     data["cores"]=cores
     data["memory"]={memory}
     data["net0"]=f"virtio,bridge={network}"
-    post_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret)
+    response = post_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret)
+    return response["data"]
 
 def resize_disk(proxmox_ip, proxmox_node, token_name, token_secret, vmid_to_use, vm_storage):
     endpoint=f"api2/json/nodes/{proxmox_node}/qemu/{vmid_to_use}/resize"
     data={}
     data["disk"]="virtio0"
     data["size"]=f"{vm_storage}G"
-    put_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret)
+    response = put_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret)
+    return response["data"]
 
 def tag_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid, vm_role, vm_branch):
     sanitized_role = re.sub(r'[^a-zA-Z0-9]', '-', vm_role)
@@ -158,21 +123,10 @@ def tag_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid, vm_role, vm
     print(f"Tagged VM {vmid} with {tags}")
     return response
 
-def is_vmid_locked(proxmox_ip, proxmox_node, token_name, token_secret, vm_id):
-    cluster_query = f"api2/json/nodes/{proxmox_node}/qemu/{vm_id}/status/current"
-    vm_status = get_cluster_query_output(cluster_query, proxmox_ip, token_name, token_secret)
-    return 'lock' in vm_status['data']
-
-def wait_for_vmid_unlock(proxmox_ip, proxmox_node, token_name, token_secret, vm_id, check_interval=10):
-    while is_vmid_locked(proxmox_ip, proxmox_node, token_name, token_secret, vm_id):
-        print(f"VMID {vm_id} is locked. Waiting for {check_interval} seconds...")
-        time.sleep(check_interval)
-    
-    print(f"VMID {vm_id} is no longer locked.")
-
 def start_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid):
     start_endpoint=f"/api2/json/nodes/{proxmox_node}/qemu/{vmid}/status/start"
-    post_cluster_query(cluster_query=start_endpoint, data=None, proxmox_ip=proxmox_ip, token_name=token_name, token_secret=token_secret)
+    response = post_cluster_query(cluster_query=start_endpoint, data=None, proxmox_ip=proxmox_ip, token_name=token_name, token_secret=token_secret)
+    return response["data"]
 
 def is_vm_running(proxmox_ip, proxmox_node, token_name, token_secret, vmid):
     """Check if the VM is currently running."""
@@ -180,57 +134,175 @@ def is_vm_running(proxmox_ip, proxmox_node, token_name, token_secret, vmid):
     response = get_cluster_query_output(cluster_query, proxmox_ip, token_name, token_secret)
     return response.get('data', {}).get('status') == 'running'
 
+def parse_vm_ips(interfaces):
+    ipv4, ipv6 = None, None
+    for interface in interfaces:
+        for ip in interface.get('ip-addresses', []):
+            if ip['ip-address-type'] == 'ipv4' and ip['ip-address'] != '127.0.0.1':
+                ipv4 = ip['ip-address']
+            if ip['ip-address-type'] == 'ipv6' and ip['ip-address'] != '::1':
+                ipv6 = ip['ip-address']
+    return ipv4, ipv6
+
 def get_vm_ip(proxmox_ip, proxmox_node, token_name, token_secret, vmid):
     """Retrieve the VM's IP addresses if it's running and the guest agent is available."""
-    if not is_vm_running(proxmox_ip, proxmox_node, token_name, token_secret, vmid):
-        print(f"VM {vmid} is not running. Cannot retrieve network interfaces.")
-        return None, None
-
+    # No separate status call: the agent endpoint itself refuses a VM that is not running
     cluster_query = f"api2/json/nodes/{proxmox_node}/qemu/{vmid}/agent/network-get-interfaces"
     try:
         response = get_cluster_query_output(cluster_query, proxmox_ip, token_name, token_secret)
-        ipv4, ipv6 = None, None
-        print(f"Network data: {response}")
-        for interface in response['data']['result']:
-            for ip in interface.get('ip-addresses', []):
-                if ip['ip-address-type'] == 'ipv4' and ip['ip-address'] != '127.0.0.1':
-                    ipv4 = ip['ip-address']
-                if ip['ip-address-type'] == 'ipv6' and ip['ip-address'] != '::1':
-                    ipv6 = ip['ip-address']
-        return ipv4, ipv6
+        return parse_vm_ips(response['data']['result'])
     except requests.exceptions.HTTPError as e:
-        if "QEMU guest agent is not running" in str(e):
-            print("QEMU guest agent is not running. Retrying...")
-        else:
-            print(f"Unexpected error: {e}")
+        # "QEMU guest agent is not running" and "VM ... not running" just mean not yet
+        if "not running" not in str(e):
+            print(f"Unexpected error for VM {vmid}: {e}")
         return None, None
 
-def create_box(proxmox_ip, proxmox_node, proxmox_pool, token_name, token_secret, low_vmid, high_vmid, template_name, vm_name, vm_role, vm_branch, vm_cores, vm_memory, vm_storage, vm_network):
-    print(f"Picking a VMID between {low_vmid} and {high_vmid}")
-    vmid_to_use=pick_vmid(proxmox_ip, token_name, token_secret, low_vmid, high_vmid)
-    print(f"Picked VMID {vmid_to_use} on {proxmox_node}")
-    print(f"Finding the VMID of the {template_name} template on {proxmox_node}")
-    template_vmid=find_template(proxmox_ip, proxmox_node, token_name, token_secret, template_name)
-    if template_vmid is None:
-        print(f"Critical failure, could not find {template_name} on {proxmox_node}, aborting")
-        SystemExit
+def create_box(proxmox_ip, proxmox_node, proxmox_pool, token_name, token_secret, low_vmid, high_vmid, template_name, vm_name, vm_role, vm_branch, vm_cores, vm_memory, vm_storage, vm_network, template_vmid=None, ensure_pool=True, placer=None, warm=False):
+    # Returns (vmid, node); with proxmox_node "auto" the node is picked by placer.
+    # With warm, a pre-cloned VM from the warm pool is used when one is available.
+    claimed = None
+    if warm:
+        with span("claim", vm_name):
+            claimed = claim_warm_vm(proxmox_ip, token_name, token_secret, template_name, None if proxmox_node == "auto" else [proxmox_node])
+        if claimed is None:
+            print(f"No warm clone of {template_name} available, cloning from scratch")
+    if claimed is not None:
+        proxmox_node = claimed["node"]
+    elif proxmox_node == "auto":
+        with span("place", vm_name):
+            proxmox_node, template_vmid = place_box(proxmox_ip, token_name, token_secret, placer, template_name, vm_name, vm_cores, vm_memory, vm_storage)
+    elif template_vmid is None:
+        print(f"Finding the VMID of the {template_name} template on {proxmox_node}")
+        template_vmid=find_template(proxmox_ip, proxmox_node, token_name, token_secret, template_name)
+        if template_vmid is None:
+            print(f"Critical failure, could not find {template_name} on {proxmox_node}, aborting")
+            raise SystemExit(1)
+    # From here on a claimed warm clone is ours; if the build fails it must not be left claimed
+    try:
+        if ensure_pool:
+            print(f"Ensuring the resource pool {proxmox_pool} exists")
+            ensure_resource_pool(proxmox_ip, token_name, token_secret, proxmox_pool)
+        if claimed is not None:
+            vmid_to_use = claimed["vmid"]
+            print(f"Turning warm clone {vmid_to_use} on {proxmox_node} into {vm_name}")
+            with span("pool", vm_name, proxmox_node):
+                set_vm_resource_pool(proxmox_ip, token_name, token_secret, proxmox_pool, vmid_to_use)
+        else:
+            print(f"Reserving a VMID between {low_vmid} and {high_vmid} by cloning {template_vmid}")
+            # clone covers picking the VMID and the clone task, retries after lost races included
+            with span("clone", vm_name, proxmox_node):
+                vmid_to_use, _ = allocate_vmid(
+                    proxmox_ip, token_name, token_secret, low_vmid, high_vmid,
+                    lambda vmid: clone_template(proxmox_ip, proxmox_node, token_name, token_secret, template_vmid, vmid, vm_name, proxmox_pool)
+                )
+            # The cached snapshot is left alone so concurrent batch workers keep sharing it: new VMIDs
+            # stay claimed in the allocator, and warm claims and refills always read a fresh one
+            print(f"Cloned {template_vmid} into VM {vmid_to_use} on {proxmox_node}")
+        with span("configure", vm_name, proxmox_node):
+            upid = configure_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid_to_use, vm_cores, vm_memory, vm_network, name=vm_name)
+            wait_for_task(proxmox_ip, token_name, token_secret, upid)
+        with span("resize", vm_name, proxmox_node):
+            upid = resize_disk(proxmox_ip, proxmox_node, token_name, token_secret, vmid_to_use, vm_storage)
+            wait_for_task(proxmox_ip, token_name, token_secret, upid)
+        with span("tag", vm_name, proxmox_node):
+            tag_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid_to_use, vm_role, vm_branch)
+        with span("start", vm_name, proxmox_node):
+            upid = start_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid_to_use)
+            wait_for_task(proxmox_ip, token_name, token_secret, upid)
+    except Exception:
+        if claimed is not None:
+            print(f"Building {vm_name} from warm clone {claimed['vmid']} failed, discarding the clone")
+            try:
+                discard_warm_vm(proxmox_ip, proxmox_node, token_name, token_secret, claimed["vmid"])
+            except Exception as e:
+                print(f"Could not discard warm clone {claimed['vmid']} on {proxmox_node}: {e}")
+        raise
+    return vmid_to_use, proxmox_node
+
+def add_warm_clone(proxmox_ip, proxmox_node, token_name, token_secret, low_vmid, high_vmid, template_name, placer=None):
+    # Full clone, stopped and poolless; the warm tag goes on last so half-made clones are never claimed
+    if proxmox_node == "auto":
+        proxmox_node, template_vmid = place_box(proxmox_ip, token_name, token_secret, placer, template_name, warm_vm_name(template_name), 0, 0, 0)
     else:
-        print(f"Proceeding to build VM {vmid_to_use} on {proxmox_node}, based on {template_vmid}")
-    print(f"Ensuring the resource pool {proxmox_pool} exists")
-    ensure_resource_pool(proxmox_ip, token_name, token_secret, proxmox_pool)
-    clone_template(proxmox_ip, proxmox_node, token_name, token_secret, template_vmid, vmid_to_use, vm_name, proxmox_pool)
-    wait_for_vmid_unlock(proxmox_ip, proxmox_node, token_name, token_secret, vmid_to_use)
-    configure_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid_to_use, vm_cores, vm_memory, vm_network)
-    wait_for_vmid_unlock(proxmox_ip, proxmox_node, token_name, token_secret, vmid_to_use)
-    resize_disk(proxmox_ip, proxmox_node, token_name, token_secret, vmid_to_use, vm_storage)
-    wait_for_vmid_unlock(proxmox_ip, proxmox_node, token_name, token_secret, vmid_to_use)
-    tag_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid_to_use, vm_role, vm_branch)
-    start_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid_to_use)
-    wait_for_vmid_unlock(proxmox_ip, proxmox_node, token_name, token_secret, vmid_to_use)
-    return vmid_to_use
-
-def write_file(proxmox_ip, proxmox_node, proxmox_pool, template_name, vm_name, vm_role, vm_branch, vm_cores, vm_memory, vm_storage, vm_network, vmid, ipv4, ipv6, file_name):
-    output_data = {
+        template_vmid = find_template(proxmox_ip, proxmox_node, token_name, token_secret, template_name)
+        if template_vmid is None:
+            raise ValueError(f"Could not find {template_name} on {proxmox_node}")
+    with span("clone", warm_vm_name(template_name), proxmox_node):
+        vmid, _ = allocate_vmid(
+            proxmox_ip, token_name, token_secret, low_vmid, high_vmid,
+            lambda vmid: clone_template(proxmox_ip, proxmox_node, token_name, token_secret, template_vmid, vmid, warm_vm_name(template_name))
+        )
+    put_cluster_query(f"api2/json/nodes/{proxmox_node}/qemu/{vmid}/config", {"tags": f"{warm_tag(template_name)},{warm_source_tag(template_vmid)}"}, proxmox_ip, token_name, token_secret)
+    print(f"Added warm clone {vmid} of {template_name} on {proxmox_node}")
+    return vmid
+
+def refill_warm_pool(proxmox_ip, proxmox_node, token_name, token_secret, low_vmid, high_vmid, targets, concurrency, placer=None):
+    snapshot = get_cluster_snapshot(proxmox_ip, token_name, token_secret, max_age=0)
+    current_by_template = {template_name: current_templates(proxmox_ip, token_name, token_secret, template_name) for template_name in targets}
+    # Clones of a template that has been rebuilt since would hand out the old image
+    for template_name in sorted(targets):
+        for vm in stale_warm_vms(snapshot, template_name, current_by_template[template_name]):
+            print(f"Warm clone {vm['vmid']} of {template_name} on {vm['node']} is from an older template, discarding it")
+            try:
+                discard_warm_vm(proxmox_ip, vm["node"], token_name, token_secret, vm["vmid"])
+            except Exception as e:
+                print(f"Could not discard warm clone {vm['vmid']}: {e}")
+    deficit = warm_deficit(snapshot, targets, current_by_template)
+    for template_name, target in sorted(targets.items()):
+        print(f"Warm pool for {template_name}: {target - deficit.get(template_name, 0)}/{target}")
+    jobs = [template_name for template_name, missing in sorted(deficit.items()) for _ in range(missing)]
+    if not jobs:
+        return [], []
+
+    added, failures = [], []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(add_warm_clone, proxmox_ip, proxmox_node, token_name, token_secret, low_vmid, high_vmid, template_name, placer): template_name
+            for template_name in jobs
+        }
+        for future in as_completed(futures):
+            template_name = futures[future]
+            try:
+                added.append(future.result())
+            except Exception as e:
+                print(f"Failed to add a warm clone of {template_name}: {e}")
+                failures.append(template_name)
+    return added, failures
+
+def wait_for_vm_ips(proxmox_ip, token_name, token_secret, vms, timeout=300, labels=None):
+    # vms maps vmid -> node. Every pending VM is polled each round, quickly at first and then
+    # backing off; returns {vmid: (ipv4, ipv6)} for the VMs that reported an address in time.
+    # labels (vmid -> VM name) names the ip spans; the VMID is used otherwise.
+    labels = labels or {}
+    pending = dict(vms)
+    found = {}
+    start_time = time.time()
+    for interval in backoff_intervals(IP_POLL_INITIAL, IP_POLL_MAX):
+        for vmid, proxmox_node in list(pending.items()):
+            ipv4, ipv6 = get_vm_ip(proxmox_ip, proxmox_node, token_name, token_secret, vmid)
+            if ipv4 or ipv6:
+                print(f"VM {vmid} IP: {ipv4}, {ipv6} after {time.time() - start_time:.1f}s")
+                record("ip", labels.get(vmid, vmid), time.time() - start_time, proxmox_node, started_at=start_time)
+                found[vmid] = (ipv4, ipv6)
+                del pending[vmid]
+        if not pending or time.time() - start_time + interval > timeout:
+            break
+        time.sleep(interval)
+
+    for vmid, proxmox_node in pending.items():
+        state = "running" if is_vm_running(proxmox_ip, proxmox_node, token_name, token_secret, vmid) else "not running"
+        print(f"Failed to retrieve VM {vmid} IP address within the timeout period (VM is {state}).")
+        record("ip", labels.get(vmid, vmid), time.time() - start_time, proxmox_node, f"no IP address, VM is {state}", start_time)
+    return found
+
+def wait_for_vm_ip(proxmox_ip, proxmox_node, token_name, token_secret, vmid, timeout=300, label=None):
+    found = wait_for_vm_ips(proxmox_ip, token_name, token_secret, {vmid: proxmox_node}, timeout, {vmid: label} if label else None)
+    if vmid not in found:
+        raise TimeoutError(f"Could not fetch VM {vmid} IP within {timeout // 60} minutes.")
+    return found[vmid]
+
+def box_metadata(proxmox_ip, proxmox_node, proxmox_pool, template_name, vm_name, vm_role, vm_branch, vm_cores, vm_memory, vm_storage, vm_network, vmid, ipv4, ipv6):
+    return {
         "proxmox_ip": proxmox_ip,
         "proxmox_node": proxmox_node,
         "proxmox_pool": proxmox_pool,
@@ -246,28 +318,118 @@ def write_file(proxmox_ip, proxmox_node, proxmox_pool, template_name, vm_name, v
         "vm_ipv4": ipv4,
         "vm_ipv6": ipv6
     }
+
+def write_file(proxmox_ip, proxmox_node, proxmox_pool, template_name, vm_name, vm_role, vm_branch, vm_cores, vm_memory, vm_storage, vm_network, vmid, ipv4, ipv6, file_name):
+    output_data = box_metadata(proxmox_ip, proxmox_node, proxmox_pool, template_name, vm_name, vm_role, vm_branch, vm_cores, vm_memory, vm_storage, vm_network, vmid, ipv4, ipv6)
     with open(file_name, 'w') as json_file:
         json.dump(output_data, json_file, indent=4)
-    
+
+BOX_FIELDS = ["template_name", "vm_name", "vm_role", "vm_branch", "vm_cores", "vm_memory", "vm_storage", "vm_network"]
+
+def load_box_specs(defaults, manifest_file=None, count=1):
+    # A manifest is a JSON list of box specs (or {"boxes": [...]}); keys left out fall back to the CLI values.
+    # --count clones every spec N times, suffixing the VM name with -1..-N
+    if manifest_file:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        entries = manifest["boxes"] if isinstance(manifest, dict) else manifest
+        specs = [{**defaults, **{k: v for k, v in entry.items() if k in BOX_FIELDS and v is not None}} for entry in entries]
+    else:
+        specs = [dict(defaults)]
+
+    if count > 1:
+        specs = [{**spec, "vm_name": f"{spec['vm_name']}-{i}"} for spec in specs for i in range(1, count + 1)]
+
+    for spec in specs:
+        missing = [field for field in BOX_FIELDS if spec.get(field) is None]
+        if missing:
+            raise ValueError(f"Box spec {spec} is missing {', '.join(missing)}")
+    return specs
+
+def build_box(proxmox_ip, proxmox_node, proxmox_pool, token_name, token_secret, low_vmid, high_vmid, spec, template_vmid, placer=None, warm=False):
+    return create_box(proxmox_ip, proxmox_node, proxmox_pool, token_name, token_secret, low_vmid, high_vmid,
+                      spec["template_name"], spec["vm_name"], spec["vm_role"], spec["vm_branch"], spec["vm_cores"],
+                      spec["vm_memory"], spec["vm_storage"], spec["vm_network"], template_vmid=template_vmid, ensure_pool=False, placer=placer, warm=warm)
+
+def create_boxes(proxmox_ip, proxmox_node, proxmox_pool, token_name, token_secret, low_vmid, high_vmid, specs, concurrency, placer=None, warm=False):
+    # Template lookups and the pool check are done once for the whole batch, not once per box
+    template_vmids = {}
+    for template_name in sorted({spec["template_name"] for spec in specs}):
+        if proxmox_node == "auto":
+            # Resolved per box once its node is chosen
+            template_vmids[template_name] = None
+            continue
+        template_vmid = find_template(proxmox_ip, proxmox_node, token_name, token_secret, template_name)
+        if template_vmid is None:
+            print(f"Critical failure, could not find {template_name} on {proxmox_node}, aborting")
+            raise SystemExit(1)
+        template_vmids[template_name] = template_vmid
+    print(f"Ensuring the resource pool {proxmox_pool} exists")
+    ensure_resource_pool(proxmox_ip, token_name, token_secret, proxmox_pool)
+
+    built, failures = {}, []
+    print(f"Building {len(specs)} boxes, {concurrency} at a time")
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(build_box, proxmox_ip, proxmox_node, proxmox_pool, token_name, token_secret, low_vmid, high_vmid, spec, template_vmids[spec["template_name"]], placer, warm): spec
+            for spec in specs
+        }
+        for future in as_completed(futures):
+            spec = futures[future]
+            try:
+                vmid, node = future.result()
+                built[vmid] = (spec, node)
+                print(f"Box {spec['vm_name']} started as VM {vmid} ({len(built)}/{len(specs)})")
+            except Exception as e:
+                print(f"Box {spec['vm_name']} failed: {e}")
+                failures.append({"vm_name": spec["vm_name"], "error": str(e)})
+
+    # One watcher polls every started box instead of a polling loop per thread
+    print(f"Waiting for {len(built)} boxes to report an IP address")
+    ips = wait_for_vm_ips(proxmox_ip, token_name, token_secret, {vmid: node for vmid, (spec, node) in built.items()},
+                          labels={vmid: spec["vm_name"] for vmid, (spec, node) in built.items()})
+    boxes = []
+    for vmid, (spec, node) in sorted(built.items()):
+        if vmid not in ips:
+            failures.append({"vm_name": spec["vm_name"], "error": f"VM {vmid} did not report an IP address"})
+            continue
+        ipv4, ipv6 = ips[vmid]
+        boxes.append(box_metadata(proxmox_ip, node, proxmox_pool, spec["template_name"], spec["vm_name"], spec["vm_role"], spec["vm_branch"],
+                                  spec["vm_cores"], spec["vm_memory"], spec["vm_storage"], spec["vm_network"], vmid, ipv4, ipv6))
+    return boxes, failures
+
+def write_timings(timings_file, prometheus_file=None):
+    print_summary()
+    write_report(timings_file, "box-creator")
+    if prometheus_file:
+        write_prometheus(prometheus_file, "box-creator")
 
 def main():
     print(f"HAJIME!")
     parser = argparse.ArgumentParser(description="Create Proxmox templates")
     parser.add_argument("--proxmox_ip", required=True, help="Proxmox IP address")
-    parser.add_argument("--proxmox_node", required=True, help="Proxmox host to build the box on")
+    parser.add_argument("--proxmox_node", required=True, help="Proxmox host to build the box on, or auto for the least loaded node that has the template")
     parser.add_argument("--proxmox_pool", required=True, help="Proxmox resource pool to build the box in")
     parser.add_argument("--token_name", required=True, help="Proxmox API token name")
     parser.add_argument("--token_secret", required=True, help="Proxmox API token secret")
     parser.add_argument("--low_vmid", required=True, help="The lowest VMID in the pool to use")
     parser.add_argument("--high_vmid", required=True, help="The highest VMID in the pool to use")
-    parser.add_argument("--template_name", required=True, help="The name of the template to use")
-    parser.add_argument("--vm_name", required=True, help="The name of the VM to create")
-    parser.add_argument("--vm_role", required=True, help="The role of the VM to create")
-    parser.add_argument("--vm_branch", required=True, help="The branch of the VM to create")
-    parser.add_argument("--vm_cores", required=True, help="Number of cores for the VM")
-    parser.add_argument("--vm_memory", required=True, help="Memory for the VM")
-    parser.add_argument("--vm_storage", required=True, help="Amount of storage, in GB")
-    parser.add_argument("--vm_network", required=True, help="interface to attach to the VM")
+    parser.add_argument("--template_name", help="The name of the template to use")
+    parser.add_argument("--vm_name", help="The name of the VM to create")
+    parser.add_argument("--vm_role", help="The role of the VM to create")
+    parser.add_argument("--vm_branch", help="The branch of the VM to create")
+    parser.add_argument("--vm_cores", help="Number of cores for the VM")
+    parser.add_argument("--vm_memory", help="Memory for the VM")
+    parser.add_argument("--vm_storage", help="Amount of storage, in GB")
+    parser.add_argument("--vm_network", help="interface to attach to the VM")
+    parser.add_argument("--manifest", help="JSON file listing boxes to build; missing fields default to the --vm_* values")
+    parser.add_argument("--count", type=int, default=1, help="Number of identical boxes to build per spec")
+    parser.add_argument("--batch_concurrency", type=int, default=8, help="Max number of boxes to build at once in batch mode")
+    parser.add_argument("--warm", action="store_true", help="Take a pre-cloned VM from the warm pool when one is available")
+    parser.add_argument("--refill_warm_pool", help="JSON file of per-template warm clone targets; tops the pool up and exits")
+    parser.add_argument("--timings_file", default="timings.json", help="Where to write the per-phase timing report, next to the VM metadata")
+    parser.add_argument("--prometheus_file", help="Also write the timings as a node_exporter textfile")
+    parser.add_argument("--batch_file", default="boxes_metadata.json", help="Where batch mode writes the metadata of every box")
 
     args = parser.parse_args()
     proxmox_ip      = args.proxmox_ip
@@ -277,41 +439,56 @@ def main():
     token_secret    = args.token_secret
     low_vmid        = args.low_vmid
     high_vmid       = args.high_vmid
-    template_name   = args.template_name
-    vm_name         = args.vm_name
-    vm_role         = args.vm_role
-    vm_branch       = args.vm_branch
-    vm_cores        = args.vm_cores
-    vm_memory       = args.vm_memory
-    vm_storage      = args.vm_storage
-    vm_network      = args.vm_network
-    vmid=create_box(proxmox_ip, proxmox_node, proxmox_pool, token_name, token_secret, low_vmid, high_vmid, template_name, vm_name, vm_role, vm_branch, vm_cores, vm_memory, vm_storage, vm_network)
-    print("Waiting for the VM to retrieve its IP address (up to 5 minutes)...")
-    file_name = "vm_metadata.json"
-    ipv4, ipv6 = None, None
-    start_time = time.time()
-    timeout = 300
-    check_interval = 15
-
-    while time.time() - start_time < timeout:
-        ipv4, ipv6 = get_vm_ip(proxmox_ip, proxmox_node, token_name, token_secret, vmid)
-        if ipv4 or ipv6:
-            print(f"VM IP: {ipv4}, {ipv6}")
-            break
-        print(f"No IP address found yet. Retrying in {check_interval} seconds...")
-        time.sleep(check_interval)
-
-    if not (ipv4 or ipv6):
-        print("Failed to retrieve VM IP address within the timeout period.")
-        raise TimeoutError("Could not fetch VM IP within 5 minutes.")
+    defaults        = {field: getattr(args, field) for field in BOX_FIELDS}
+    # One placer per run, so boxes placed earlier in a batch count against their node
+    placer          = NodePlacer(proxmox_ip, token_name, token_secret, BOX_STORAGE) if proxmox_node == "auto" else None
+
+    if args.refill_warm_pool:
+        added, failures = refill_warm_pool(proxmox_ip, proxmox_node, token_name, token_secret, low_vmid, high_vmid, load_targets(args.refill_warm_pool), args.batch_concurrency, placer)
+        print(f"Added {len(added)} warm clones")
+        write_timings(args.timings_file, args.prometheus_file)
+        if failures:
+            raise SystemExit(f"Failed to add {len(failures)} warm clones")
+        return
 
-    write_file(proxmox_ip, proxmox_node, proxmox_pool, template_name, vm_name, vm_role, vm_branch, vm_cores, vm_memory, vm_storage, vm_network, vmid, ipv4, ipv6, file_name)
-    print(f"Wrote VM data to {file_name}")
-
-    write_file(proxmox_ip, proxmox_node, proxmox_pool, template_name, vm_name, vm_role, vm_branch, vm_cores, vm_memory, vm_storage, vm_network, vmid, ipv4, ipv6, file_name)
-    print(f"Wrote VM data to {file_name}")
+    try:
+        specs = load_box_specs(defaults, args.manifest, args.count)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.manifest or args.count > 1:
+        boxes, failures = create_boxes(proxmox_ip, proxmox_node, proxmox_pool, token_name, token_secret, low_vmid, high_vmid, specs, args.batch_concurrency, placer, args.warm)
+        with open(args.batch_file, 'w') as json_file:
+            json.dump({"boxes": boxes, "failures": failures}, json_file, indent=4)
+        print(f"Wrote data for {len(boxes)} boxes to {args.batch_file}")
+        write_timings(args.timings_file, args.prometheus_file)
+        if failures:
+            raise SystemExit(f"{len(failures)} of {len(specs)} boxes failed")
+        print(f"DUNZO!!!")
+        return
+
+    spec = specs[0]
+    template_name   = spec["template_name"]
+    vm_name         = spec["vm_name"]
+    vm_role         = spec["vm_role"]
+    vm_branch       = spec["vm_branch"]
+    vm_cores        = spec["vm_cores"]
+    vm_memory       = spec["vm_memory"]
+    vm_storage      = spec["vm_storage"]
+    vm_network      = spec["vm_network"]
+    # Timings are written even when the box fails, so the archived report shows which phase it was
+    try:
+        vmid, proxmox_node = create_box(proxmox_ip, proxmox_node, proxmox_pool, token_name, token_secret, low_vmid, high_vmid, template_name, vm_name, vm_role, vm_branch, vm_cores, vm_memory, vm_storage, vm_network, placer=placer, warm=args.warm)
+        print("Waiting for the VM to retrieve its IP address (up to 5 minutes)...")
+        file_name = "vm_metadata.json"
+        ipv4, ipv6 = wait_for_vm_ip(proxmox_ip, proxmox_node, token_name, token_secret, vmid, label=vm_name)
+
+        write_file(proxmox_ip, proxmox_node, proxmox_pool, template_name, vm_name, vm_role, vm_branch, vm_cores, vm_memory, vm_storage, vm_network, vmid, ipv4, ipv6, file_name)
+        print(f"Wrote VM data to {file_name}")
+    finally:
+        write_timings(args.timings_file, args.prometheus_file)
     print(f"DUNZO!!!")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,100 +1,133 @@
 import argparse
-import requests
-import time
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def get_cluster_query_output(cluster_query, proxmox_ip, token_name, token_secret):
-    api_url = f"https://{proxmox_ip}:8006/{cluster_query}"
-    headers = {
-        "Authorization": f"PVEAPIToken={token_name}={token_secret}"
-    }
-    
-    response = requests.get(api_url, headers=headers, verify=False)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        response.raise_for_status()
-
-def post_cluster_query(cluster_query, data, proxmox_ip, token_name, token_secret):
-    api_url = f"https://{proxmox_ip}:8006/{cluster_query}"
-    headers = {
-        "Authorization": f"PVEAPIToken={token_name}={token_secret}"
-    }
-
-    response = requests.post(api_url, headers=headers, data=data, verify=False)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        response.raise_for_status()
-
-def delete_cluster_query(cluster_query, proxmox_ip, token_name, token_secret):
-    api_url = f"https://{proxmox_ip}:8006/{cluster_query}"
-    headers = {
-        "Authorization": f"PVEAPIToken={token_name}={token_secret}"
-    }
-
-    response = requests.delete(api_url, headers=headers, verify=False)
-    
-    if response.status_code in (200, 204):
-        return "Deletion successful"
-    else:
-        response.raise_for_status()
-
-def is_vmid_locked(proxmox_ip, proxmox_node, token_name, token_secret, vm_id):
-    cluster_query = f"api2/json/nodes/{proxmox_node}/qemu/{vm_id}/status/current"
-    vm_status = get_cluster_query_output(cluster_query, proxmox_ip, token_name, token_secret)
-    return 'lock' in vm_status['data']
-
-def wait_for_vmid_unlock(proxmox_ip, proxmox_node, token_name, token_secret, vm_id, check_interval=10):
-    while is_vmid_locked(proxmox_ip, proxmox_node, token_name, token_secret, vm_id):
-        print(f"VMID {vm_id} is locked. Waiting for {check_interval} seconds...")
-        time.sleep(check_interval)
-    
-    print(f"VMID {vm_id} is no longer locked.")
-
-def find_vm_node(proxmox_ip, vmid, token_name, token_secret):
-    vms = get_cluster_query_output("api2/json/cluster/resources", proxmox_ip, token_name, token_secret)["data"]
-    for vm in vms:
-        if vm["type"] == "qemu" and vm["vmid"] == vmid:
-            return vm["node"]
-    raise ValueError(f"VM with ID {vmid} not found.")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from proxmox_api import post_cluster_query, delete_cluster_query
+from proxmox_tasks import wait_for_task, wait_for_vm_status
+from cluster_resources import get_cluster_snapshot, invalidate_cluster_snapshot, vm_tags
+from timing import print_summary, span, write_prometheus, write_report
 
 def stop_vm(proxmox_ip, node, vmid, token_name, token_secret):
     stop_endpoint = f"api2/json/nodes/{node}/qemu/{vmid}/status/stop"
     print(f"Stopping VM {vmid} on node {node}...")
-    post_cluster_query(stop_endpoint, None, proxmox_ip, token_name, token_secret)
+    response = post_cluster_query(stop_endpoint, None, proxmox_ip, token_name, token_secret)
+    wait_for_task(proxmox_ip, token_name, token_secret, response)
     print(f"VM {vmid} stopped successfully.")
 
 def delete_vm(proxmox_ip, node, vmid, token_name, token_secret):
     delete_endpoint = f"api2/json/nodes/{node}/qemu/{vmid}?destroy-unreferenced-disks=1&purge=1"
     print(f"Deleting VM {vmid} on node {node}...")
-    delete_cluster_query(delete_endpoint, proxmox_ip, token_name, token_secret)
+    response = delete_cluster_query(delete_endpoint, proxmox_ip, token_name, token_secret)
+    wait_for_task(proxmox_ip, token_name, token_secret, response)
+    invalidate_cluster_snapshot(proxmox_ip)
     print(f"VM {vmid} deleted successfully.")
 
+def sanitize_tag_value(value):
+    # Same rule tag_vm in box-creator uses when it writes role.* / branch.* tags
+    return re.sub(r'[^a-zA-Z0-9]', '-', value)
+
+def select_vms(snapshot, vmids=None, tags=None, pool=None):
+    # All selectors given must match; templates are never selected
+    if vmids:
+        candidates = [snapshot["by_vmid"][vmid] for vmid in vmids if vmid in snapshot["by_vmid"]]
+        missing = [vmid for vmid in vmids if vmid not in snapshot["by_vmid"]]
+        if missing:
+            print(f"VMs not found, skipping: {', '.join(str(vmid) for vmid in missing)}")
+    else:
+        candidates = list(snapshot["by_vmid"].values())
+
+    selected = []
+    for vm in candidates:
+        if vm.get("template", 0) == 1:
+            if vmids:
+                print(f"VM {vm['vmid']} ({vm.get('name')}) is a template, skipping")
+            continue
+        if tags and not set(tag.lower() for tag in tags) <= vm_tags(vm):
+            continue
+        if pool and vm.get("pool") != pool:
+            continue
+        selected.append(vm)
+    return sorted(selected, key=lambda vm: vm["vmid"])
+
+def terminate_vm(proxmox_ip, vm, token_name, token_secret):
+    node = vm["node"]
+    vmid = vm["vmid"]
+    label = vm.get("name") or vmid
+    with span("stop", label, node):
+        if vm.get("status") != "stopped":
+            stop_vm(proxmox_ip, node, vmid, token_name, token_secret)
+        wait_for_vm_status(proxmox_ip, node, token_name, token_secret, vmid, "stopped")
+    with span("delete", label, node):
+        delete_vm(proxmox_ip, node, vmid, token_name, token_secret)
+    return vmid
+
+def terminate_vms(proxmox_ip, vms, token_name, token_secret, concurrency):
+    deleted, failures = [], []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(terminate_vm, proxmox_ip, vm, token_name, token_secret): vm for vm in vms}
+        for future in as_completed(futures):
+            vm = futures[future]
+            try:
+                deleted.append(future.result())
+            except Exception as e:
+                print(f"Failed to terminate VM {vm['vmid']} on {vm['node']}: {e}")
+                failures.append(vm["vmid"])
+    return sorted(deleted), sorted(failures)
+
 def main():
-    parser = argparse.ArgumentParser(description="Delete a Proxmox VM")
+    parser = argparse.ArgumentParser(description="Delete Proxmox VMs")
     parser.add_argument("--proxmox_ip", required=True, help="Proxmox IP address")
-    parser.add_argument("--vmid", required=True, type=int, help="VM ID to delete")
+    parser.add_argument("--vmid", type=int, help="VM ID to delete")
+    parser.add_argument("--vmids", help="Comma separated list of VM IDs to delete")
+    parser.add_argument("--role", help="Delete VMs tagged role.<role> by box-creator")
+    parser.add_argument("--branch", help="Delete VMs tagged branch.<branch> by box-creator")
+    parser.add_argument("--pool", help="Delete VMs in this resource pool")
+    parser.add_argument("--concurrency", type=int, default=8, help="Max number of VMs to stop and delete at once")
+    parser.add_argument("--dry_run", action="store_true", help="Only list the VMs that would be deleted")
+    parser.add_argument("--timings_file", default="timings.json", help="Where to write the per-phase timing report")
+    parser.add_argument("--prometheus_file", help="Also write the timings as a node_exporter textfile")
     parser.add_argument("--token_name", required=True, help="Proxmox API token name")
     parser.add_argument("--token_secret", required=True, help="Proxmox API token secret")
     
     args = parser.parse_args()
 
     proxmox_ip = args.proxmox_ip
-    vmid = args.vmid
     token_name = args.token_name
     token_secret = args.token_secret
 
-    node = find_vm_node(proxmox_ip, vmid, token_name, token_secret)
-    print(f"VM {vmid} is running on node {node}.")
+    vmids = []
+    if args.vmid is not None:
+        vmids.append(args.vmid)
+    if args.vmids:
+        vmids.extend(int(vmid) for vmid in args.vmids.split(",") if vmid.strip())
+    tags = []
+    if args.role:
+        tags.append(f"role.{sanitize_tag_value(args.role)}")
+    if args.branch:
+        tags.append(f"branch.{sanitize_tag_value(args.branch)}")
+    if not (vmids or tags or args.pool):
+        parser.error("Give at least one of --vmid, --vmids, --role, --branch or --pool")
 
-    stop_vm(proxmox_ip, node, vmid, token_name, token_secret)
-    wait_for_vmid_unlock(proxmox_ip, node, token_name, token_secret, vmid)
-    print("Waiting 30 seconds for the machine to actually shut down")
-    time.sleep(30)
-    
-    delete_vm(proxmox_ip, node, vmid, token_name, token_secret)
+    snapshot = get_cluster_snapshot(proxmox_ip, token_name, token_secret)
+    vms = select_vms(snapshot, vmids=vmids, tags=tags, pool=args.pool)
+    if not vms:
+        raise ValueError("No VMs matched the selection.")
+    for vm in vms:
+        print(f"VM {vm['vmid']} ({vm.get('name')}) is {vm.get('status')} on node {vm['node']}.")
+    if args.dry_run:
+        return
+
+    deleted, failures = terminate_vms(proxmox_ip, vms, token_name, token_secret, args.concurrency)
+    print(f"Deleted {len(deleted)} VMs: {', '.join(str(vmid) for vmid in deleted)}")
+    print_summary()
+    write_report(args.timings_file, "box-terminator")
+    if args.prometheus_file:
+        write_prometheus(args.prometheus_file, "box-terminator")
+    if failures:
+        raise SystemExit(f"Failed to delete VMs: {', '.join(str(vmid) for vmid in failures)}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,80 @@
+import re
+import threading
+import time
+from proxmox_api import get_cluster_query_output
+
+# Seconds a cluster snapshot may be reused before it is fetched again
+SNAPSHOT_TTL = 5
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+_refresh_locks = {}
+
+def build_snapshot(resources):
+    snapshot = {
+        "fetched_at": time.time(),
+        "by_vmid": {},
+        "by_name": {},
+        "by_node": {},
+    }
+    for vm in resources:
+        if vm.get("type") != "qemu":
+            continue
+        key = (vm.get("name"), int(vm.get("template", 0)))
+        snapshot["by_vmid"][vm["vmid"]] = vm
+        snapshot["by_name"].setdefault(key, []).append(vm)
+        snapshot["by_node"].setdefault(vm["node"], []).append(vm)
+    return snapshot
+
+def _refresh_lock(proxmox_ip):
+    with _snapshots_lock:
+        return _refresh_locks.setdefault(proxmox_ip, threading.Lock())
+
+def get_cluster_snapshot(proxmox_ip, token_name, token_secret, max_age=SNAPSHOT_TTL):
+    # Threads that miss the cache together wait on one fetch instead of each scanning the cluster
+    with _refresh_lock(proxmox_ip):
+        snapshot = _snapshots.get(proxmox_ip)
+        if snapshot is None or time.time() - snapshot["fetched_at"] > max_age:
+            resources = get_cluster_query_output("api2/json/cluster/resources", proxmox_ip, token_name, token_secret, params={"type": "vm"})["data"]
+            snapshot = build_snapshot(resources)
+            _snapshots[proxmox_ip] = snapshot
+        return snapshot
+
+def invalidate_cluster_snapshot(proxmox_ip):
+    # Call after anything that adds, removes, renames, retags or moves a VM
+    with _snapshots_lock:
+        _snapshots.pop(proxmox_ip, None)
+
+def lookup_vm(snapshot, vmid):
+    return snapshot["by_vmid"].get(int(vmid))
+
+def lookup_by_name(snapshot, name, template=False, proxmox_node=None):
+    matches = snapshot["by_name"].get((name, 1 if template else 0), [])
+    if proxmox_node is not None:
+        matches = [vm for vm in matches if vm["node"] == proxmox_node]
+    return matches
+
+def vms_on_node(snapshot, proxmox_node):
+    return snapshot["by_node"].get(proxmox_node, [])
+
+def vm_tags(vm):
+    # cluster/resources joins tags with ';' (older releases used ',')
+    return set(tag.lower() for tag in re.split(r'[;,\s]+', vm.get("tags", "")) if tag)
+
+def vm_ctime(config):
+    # "meta: creation-qemu=8.1.2,ctime=1700000000", written by PVE 7.2+ on create and clone
+    match = re.search(r"ctime=(\d+)", config.get("meta", ""))
+    return int(match.group(1)) if match else 0
+
+def newest_template(proxmox_ip, token_name, token_secret, template_name, proxmox_node):
+    # Rebuilds leave older templates of the same name behind; the most recently created one is
+    # current. Configs are only read when there is more than one to choose from.
+    snapshot = get_cluster_snapshot(proxmox_ip, token_name, token_secret)
+    matches = lookup_by_name(snapshot, template_name, template=True, proxmox_node=proxmox_node)
+    if len(matches) <= 1:
+        return matches[0] if matches else None
+    ctimes = {}
+    for vm in matches:
+        config = get_cluster_query_output(f"api2/json/nodes/{proxmox_node}/qemu/{vm['vmid']}/config", proxmox_ip, token_name, token_secret)["data"]
+        ctimes[vm["vmid"]] = vm_ctime(config)
+    return max(matches, key=lambda vm: (ctimes[vm["vmid"]], vm["vmid"]))
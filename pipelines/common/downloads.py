@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import posixpath
+import threading
+import time
+from queue import Queue, Empty
+from urllib.parse import urlsplit, urlunsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 1024 * 1024
+# Each connection fetches the file in SEGMENT_SIZE ranges; finished ranges are what a resume skips
+SEGMENT_SIZE = 16 * 1024 * 1024
+DEFAULT_CONNECTIONS = 4
+SEGMENT_RETRIES = 3
+
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_maxsize=32))
+_session.mount("http://", HTTPAdapter(pool_maxsize=32))
+
+def get_download_session():
+    return _session
+
+def default_checksums_url(url):
+    # Ubuntu (and most distro mirrors) publish SHA256SUMS next to the images
+    parts = urlsplit(url)
+    return urlunsplit(parts._replace(path=posixpath.join(posixpath.dirname(parts.path), "SHA256SUMS")))
+
+def expected_sha256(url, checksums_url):
+    # Returns the published digest for the file, or None when the distro does not publish one
+    try:
+        response = _session.get(checksums_url, timeout=(5, 30))
+    except requests.exceptions.RequestException as e:
+        print(f"Could not fetch {checksums_url}: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"No checksums published at {checksums_url} ({response.status_code}), skipping verification")
+        return None
+    filename = posixpath.basename(urlsplit(url).path)
+    for line in response.text.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[1].lstrip("*") == filename:
+            return fields[0].lower()
+    print(f"{filename} is not listed in {checksums_url}, skipping verification")
+    return None
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def state_path(output_path):
+    return f"{output_path}.state.json"
+
+def load_state(output_path):
+    try:
+        with open(state_path(output_path)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def save_state(output_path, state):
+    tmp_path = f"{state_path(output_path)}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path(output_path))
+
+def probe(url, headers=None):
+    # HEAD can be refused by some mirrors; a one byte ranged GET tells us the same things.
+    # headers may carry If-None-Match/If-Modified-Since, in which case status can be 304.
+    headers = dict(headers or {})
+    response = _session.head(url, headers=headers, allow_redirects=True, timeout=(5, 30))
+    if response.status_code >= 400:
+        response = _session.get(url, headers={**headers, "Range": "bytes=0-0"}, stream=True, timeout=(5, 30))
+        response.close()
+        response.raise_for_status()
+    size = None
+    if response.status_code == 206 and "/" in response.headers.get("Content-Range", ""):
+        size = int(response.headers["Content-Range"].rsplit("/", 1)[1])
+    elif response.headers.get("Content-Length"):
+        size = int(response.headers["Content-Length"])
+    return {
+        "url": response.url,
+        "status": response.status_code,
+        "size": size,
+        "ranges": response.headers.get("Accept-Ranges", "").lower() == "bytes" or response.status_code == 206,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+def download_single(url, output_path):
+    with _session.get(url, stream=True, timeout=(10, 120)) as response:
+        response.raise_for_status()
+        with open(output_path, "wb") as file:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                file.write(chunk)
+
+def fetch_segment(url, fd, start, end, validator):
+    headers = {"Range": f"bytes={start}-{end}"}
+    if validator:
+        # If the file changed upstream mid-download the server answers 200 instead of 206
+        headers["If-Range"] = validator
+    with _session.get(url, headers=headers, stream=True, timeout=(10, 120)) as response:
+        if response.status_code != 206:
+            response.raise_for_status()
+            raise RuntimeError(f"{url} ignored the range request for bytes {start}-{end} ({response.status_code})")
+        offset = start
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+    if offset != end + 1:
+        raise RuntimeError(f"Short read for bytes {start}-{end} of {url}: got {offset - start} bytes")
+
+def download_file(url, output_path, connections=DEFAULT_CONNECTIONS, expected_digest=None, segment_size=SEGMENT_SIZE):
+    # Fetches url into output_path over `connections` parallel range requests into a preallocated
+    # file. Progress lives in <output_path>.state.json, so an interrupted run resumes where it stopped.
+    # Returns the sha256 of the finished file and raises if it does not match expected_digest.
+    info = probe(url)
+    if connections <= 1 or not info["ranges"] or not info["size"]:
+        print(f"Downloading {url} over a single connection")
+        download_single(url, output_path)
+    else:
+        size = info["size"]
+        segments = [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+        state = load_state(output_path)
+        resumable = (
+            state is not None
+            and os.path.exists(output_path)
+            and state.get("url") == url
+            and state.get("size") == size
+            and state.get("segment_size") == segment_size
+            and state.get("etag") == info["etag"]
+            and state.get("last_modified") == info["last_modified"]
+        )
+        if resumable:
+            done = set(state["done"])
+            print(f"Resuming {url}: {len(done)}/{len(segments)} segments already on disk")
+        else:
+            done = set()
+            state = {"url": url, "size": size, "segment_size": segment_size, "etag": info["etag"], "last_modified": info["last_modified"], "done": []}
+            with open(output_path, "wb") as file:
+                file.truncate(size)
+            save_state(output_path, state)
+
+        pending = Queue()
+        for index, segment in enumerate(segments):
+            if index not in done:
+                pending.put((index, segment))
+        state_lock = threading.Lock()
+        errors = []
+        validator = info["etag"] or info["last_modified"]
+        start_time = time.time()
+
+        def worker(fd):
+            while not errors:
+                try:
+                    index, (start, end) = pending.get(block=False)
+                except Empty:
+                    return
+                for attempt in range(1, SEGMENT_RETRIES + 1):
+                    try:
+                        fetch_segment(info["url"], fd, start, end, validator)
+                        break
+                    except (requests.exceptions.RequestException, RuntimeError) as e:
+                        if attempt == SEGMENT_RETRIES:
+                            errors.append(e)
+                            return
+                        print(f"Segment {index} of {url} failed ({e}), retrying")
+                        time.sleep(attempt)
+                with state_lock:
+                    done.add(index)
+                    state["done"] = sorted(done)
+                    save_state(output_path, state)
+
+        print(f"Downloading {url} ({size} bytes) over {connections} connections")
+        fd = os.open(output_path, os.O_RDWR)
+        try:
+            threads = [threading.Thread(target=worker, args=(fd,)) for _ in range(min(connections, pending.qsize() or 1))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            os.close(fd)
+        if errors:
+            raise errors[0]
+        elapsed = max(time.time() - start_time, 0.001)
+        print(f"Downloaded {url} in {elapsed:.1f}s ({size / elapsed / 1024 ** 2:.1f} MiB/s)")
+
+    digest = sha256_file(output_path)
+    if os.path.exists(state_path(output_path)):
+        os.remove(state_path(output_path))
+    if expected_digest and expected_digest.lower() != digest:
+        os.remove(output_path)
+        raise ValueError(f"Checksum mismatch for {url}: expected {expected_digest}, got {digest}")
+    return digest
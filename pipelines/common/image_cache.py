@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from downloads import DEFAULT_CONNECTIONS, default_checksums_url, download_file, expected_sha256, probe
+
+# Default byte budget for cached images; least recently used blobs are evicted past it
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+_index_lock = threading.Lock()
+_url_locks = {}
+# Digests handed out during this run; eviction never removes them from under a caller
+_pinned = set()
+
+def blob_path(cache_dir, digest):
+    return os.path.join(cache_dir, "blobs", "sha256", digest)
+
+def index_path(cache_dir):
+    return os.path.join(cache_dir, "index.json")
+
+def load_index(cache_dir):
+    try:
+        with open(index_path(cache_dir)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_index(cache_dir, index):
+    # Write-then-rename so an interrupted run never leaves a truncated index behind
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".index-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(index, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, index_path(cache_dir))
+
+def _url_lock(image_url):
+    with _index_lock:
+        return _url_locks.setdefault(image_url, threading.Lock())
+
+def store_file(cache_dir, path, digest):
+    # Identical content from any URL shares one blob
+    final_path = blob_path(cache_dir, digest)
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    os.replace(path, final_path)
+    return final_path
+
+def evict(cache_dir, index, max_bytes):
+    # Drops least recently used blobs until the cache fits in max_bytes
+    blobs = {}
+    for url, entry in index.items():
+        blob = blobs.setdefault(entry["sha256"], {"size": entry["size"], "last_used": 0, "urls": []})
+        blob["last_used"] = max(blob["last_used"], entry.get("last_used", 0))
+        blob["urls"].append(url)
+
+    total = sum(blob["size"] for blob in blobs.values())
+    for digest, blob in sorted(blobs.items(), key=lambda item: item[1]["last_used"]):
+        if total <= max_bytes:
+            break
+        if digest in _pinned:
+            continue
+        print(f"Evicting cached image {digest[:12]} ({blob['size']} bytes) used by {', '.join(blob['urls'])}")
+        if os.path.exists(blob_path(cache_dir, digest)):
+            os.remove(blob_path(cache_dir, digest))
+        for url in blob["urls"]:
+            del index[url]
+        total -= blob["size"]
+
+def unchanged(info, entry):
+    # Some mirrors ignore conditional headers and answer 200 (or 206 to the ranged fallback);
+    # matching validators still mean the same image
+    if info["status"] not in (200, 206):
+        return False
+    if entry.get("etag") and info["etag"] == entry["etag"]:
+        return True
+    return bool(entry.get("last_modified")) and info["last_modified"] == entry["last_modified"]
+
+def fetch_image(image_url, cache_dir, max_bytes=DEFAULT_MAX_BYTES, checksums_url=None, connections=DEFAULT_CONNECTIONS):
+    # Returns the path of a cached, verified copy of image_url. An unchanged upstream image
+    # costs one conditional request answered with 304 (or a 200 carrying the same ETag); nothing is downloaded.
+    os.makedirs(cache_dir, exist_ok=True)
+    with _url_lock(image_url):
+        with _index_lock:
+            entry = load_index(cache_dir).get(image_url)
+
+        headers = {}
+        if entry and os.path.exists(blob_path(cache_dir, entry["sha256"])):
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        else:
+            entry = None
+
+        # A conditional probe is all an unchanged image costs; changed ones go through the ranged downloader.
+        # probe falls back to a one byte GET on mirrors that refuse HEAD and raises on errors.
+        info = probe(image_url, headers)
+        current = entry is not None and (info["status"] == 304 or unchanged(info, entry))
+
+        if current:
+            print(f"Cached image for {image_url} is current ({entry['sha256'][:12]})")
+            digest = entry["sha256"]
+        else:
+            print(f"Downloading {image_url} into the image cache")
+            tmp_dir = os.path.join(cache_dir, "tmp")
+            os.makedirs(tmp_dir, exist_ok=True)
+            # Stable per-URL partial name so an interrupted download resumes on the next run
+            partial_path = os.path.join(tmp_dir, hashlib.sha256(image_url.encode()).hexdigest())
+            wanted = expected_sha256(image_url, checksums_url or default_checksums_url(image_url))
+            digest = download_file(image_url, partial_path, connections=connections, expected_digest=wanted)
+            size = os.path.getsize(partial_path)
+            store_file(cache_dir, partial_path, digest)
+            entry = {
+                "sha256": digest,
+                "size": size,
+                "etag": info["etag"],
+                "last_modified": info["last_modified"],
+                "verified": bool(wanted),
+            }
+
+        with _index_lock:
+            _pinned.add(digest)
+            index = load_index(cache_dir)
+            index[image_url] = {**entry, "last_used": time.time()}
+            evict(cache_dir, index, max_bytes)
+            save_index(cache_dir, index)
+
+    return blob_path(cache_dir, digest)
@@ -0,0 +1,100 @@
+import threading
+import time
+from proxmox_api import get_cluster_query_output
+
+# Seconds node and storage usage may be reused between placement decisions
+RESOURCES_TTL = 10
+
+def get_node_resources(proxmox_ip, token_name, token_secret):
+    # Online nodes by name and available storages by (node, storage), from one cluster/resources call
+    resources = get_cluster_query_output("api2/json/cluster/resources", proxmox_ip, token_name, token_secret)["data"]
+    nodes, storages = {}, {}
+    for item in resources:
+        if item.get("type") == "node" and item.get("status") == "online":
+            nodes[item["node"]] = item
+        elif item.get("type") == "storage" and item.get("status") == "available":
+            storages[(item["node"], item["storage"])] = item
+    return nodes, storages
+
+def get_node_addresses(proxmox_ip, token_name, token_secret):
+    # Node name -> IP from cluster/status, for the steps that SSH to the node itself
+    status = get_cluster_query_output("api2/json/cluster/status", proxmox_ip, token_name, token_secret)["data"]
+    return {item["name"]: item["ip"] for item in status if item.get("type") == "node" and item.get("ip")}
+
+def node_headroom(node, storage, reserved):
+    # Free memory (bytes), idle cores and free storage (bytes) left after what this process already placed
+    free_memory = node.get("maxmem", 0) - node.get("mem", 0) - reserved["memory"]
+    idle_cores = node.get("maxcpu", 0) * (1 - node.get("cpu", 0)) - reserved["cores"]
+    free_disk = storage.get("maxdisk", 0) - storage.get("disk", 0) - reserved["disk"]
+    return free_memory, idle_cores, free_disk
+
+def score_node(node, storage, reserved):
+    # Equal weight for the free fraction of memory, CPU and storage
+    free_memory, idle_cores, free_disk = node_headroom(node, storage, reserved)
+    return (
+        free_memory / max(node.get("maxmem", 0), 1)
+        + max(idle_cores, 0) / max(node.get("maxcpu", 0), 1)
+        + free_disk / max(storage.get("maxdisk", 0), 1)
+    )
+
+class NodePlacer:
+    # Spreads concurrent builds over nodes by memory, CPU and storage headroom. cluster/resources lags
+    # behind what was just created, so placements made by this process count against a node until released.
+    def __init__(self, proxmox_ip, token_name, token_secret, storage, allowlist=None):
+        self.proxmox_ip = proxmox_ip
+        self.token_name = token_name
+        self.token_secret = token_secret
+        self.storage = storage
+        self.allowlist = set(allowlist) if allowlist else None
+        self._lock = threading.Lock()
+        self._reserved = {}
+        self._resources = None
+        self._fetched_at = 0
+
+    def _node_resources(self):
+        if self._resources is None or time.time() - self._fetched_at > RESOURCES_TTL:
+            self._resources = get_node_resources(self.proxmox_ip, self.token_name, self.token_secret)
+            self._fetched_at = time.time()
+        return self._resources
+
+    def _reservation(self, name):
+        return self._reserved.setdefault(name, {"cores": 0, "memory": 0, "disk": 0})
+
+    def choose(self, label, cores, memory, disk, candidates=None):
+        # memory and disk in bytes; candidates optionally narrows the allowlist further
+        with self._lock:
+            nodes, storages = self._node_resources()
+            scored = []
+            for name, node in nodes.items():
+                if self.allowlist is not None and name not in self.allowlist:
+                    continue
+                if candidates is not None and name not in candidates:
+                    continue
+                storage = storages.get((name, self.storage))
+                if storage is None:
+                    continue
+                reserved = self._reservation(name)
+                free_memory, idle_cores, free_disk = node_headroom(node, storage, reserved)
+                if free_memory < memory or free_disk < disk:
+                    continue
+                scored.append((score_node(node, storage, reserved), name))
+            if not scored:
+                allowed = ", ".join(sorted(self.allowlist)) if self.allowlist else "the cluster"
+                raise ValueError(f"No node in {allowed} has {memory} bytes of memory and {disk} bytes on {self.storage} free for {label}")
+
+            score, name = max(scored)
+            reserved = self._reservation(name)
+            reserved["cores"] += cores
+            reserved["memory"] += memory
+            reserved["disk"] += disk
+            print(f"Placing {label} on {name} (score {score:.2f} of {len(scored)} candidates)")
+            return name
+
+    def release(self, name, cores, memory, disk):
+        with self._lock:
+            reserved = self._reservation(name)
+            reserved["cores"] -= cores
+            reserved["memory"] -= memory
+            reserved["disk"] -= disk
+            # Force the next choice to see the finished build in cluster/resources
+            self._resources = None
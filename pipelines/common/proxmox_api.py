@@ -0,0 +1,70 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# (connect, read) timeout in seconds applied to every API call unless overridden
+DEFAULT_TIMEOUT = (5, 60)
+# Keep-alive sockets per Proxmox host; sized for the template-creator worker threads
+POOL_SIZE = 16
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(proxmox_ip, token_name, token_secret):
+    # One pooled keep-alive session per (host, token), shared by every thread in the process
+    key = (proxmox_ip, token_name, token_secret)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            session.headers["Authorization"] = f"PVEAPIToken={token_name}={token_secret}"
+            session.verify = False
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            _sessions[key] = session
+    return session
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+def api_url(proxmox_ip, cluster_query):
+    return f"https://{proxmox_ip}:8006/{cluster_query.lstrip('/')}"
+
+def get_cluster_query_output(cluster_query, proxmox_ip, token_name, token_secret, params=None, timeout=DEFAULT_TIMEOUT):
+    session = get_session(proxmox_ip, token_name, token_secret)
+    response = session.get(api_url(proxmox_ip, cluster_query), params=params, timeout=timeout)
+
+    if response.status_code == 200:
+        return response.json()
+    else:
+        response.raise_for_status()
+
+def delete_cluster_query(cluster_query, proxmox_ip, token_name, token_secret, timeout=DEFAULT_TIMEOUT):
+    session = get_session(proxmox_ip, token_name, token_secret)
+    response = session.delete(api_url(proxmox_ip, cluster_query), timeout=timeout)
+
+    if response.status_code in (200, 204):
+        return response.json() if response.content else "Deletion successful"
+    else:
+        response.raise_for_status()
+
+def post_cluster_query(cluster_query, data, proxmox_ip, token_name, token_secret, timeout=DEFAULT_TIMEOUT):
+    session = get_session(proxmox_ip, token_name, token_secret)
+    response = session.post(api_url(proxmox_ip, cluster_query), data=data or None, timeout=timeout)
+
+    if response.status_code == 200:
+        return response.json()
+    else:
+        response.raise_for_status()
+
+def put_cluster_query(cluster_query, data, proxmox_ip, token_name, token_secret, timeout=DEFAULT_TIMEOUT):
+    session = get_session(proxmox_ip, token_name, token_secret)
+    response = session.put(api_url(proxmox_ip, cluster_query), data=data, timeout=timeout)
+
+    if response.status_code == 200:
+        return response.json()
+    else:
+        response.raise_for_status()
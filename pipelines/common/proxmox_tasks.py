@@ -0,0 +1,68 @@
+import time
+from urllib.parse import quote
+from proxmox_api import get_cluster_query_output
+
+# Poll quickly at first so short tasks (config, start) return within a few hundred ms,
+# then back off so long clones and disk moves do not hammer the API
+INITIAL_INTERVAL = 0.05
+MAX_INTERVAL = 2.0
+BACKOFF_FACTOR = 1.5
+
+def is_upid(value):
+    return isinstance(value, str) and value.startswith("UPID:")
+
+def upid_from_response(response):
+    # Async endpoints answer {"data": "UPID:..."}, synchronous ones answer {"data": null}
+    if isinstance(response, dict):
+        response = response.get("data")
+    return response if is_upid(response) else None
+
+def upid_node(upid):
+    # UPID:<node>:<pid>:<pstart>:<starttime>:<type>:<id>:<user>:
+    return upid.split(":")[1]
+
+def task_succeeded(exitstatus):
+    return exitstatus == "OK" or (exitstatus or "").startswith("WARNINGS")
+
+def get_task_status(proxmox_ip, token_name, token_secret, upid):
+    cluster_query = f"api2/json/nodes/{upid_node(upid)}/tasks/{quote(upid, safe='')}/status"
+    return get_cluster_query_output(cluster_query, proxmox_ip, token_name, token_secret)["data"]
+
+def backoff_intervals(initial=INITIAL_INTERVAL, maximum=MAX_INTERVAL, factor=BACKOFF_FACTOR):
+    interval = initial
+    while True:
+        yield interval
+        interval = min(interval * factor, maximum)
+
+def wait_for_task(proxmox_ip, token_name, token_secret, upid, timeout=900, check=True):
+    # Accepts a UPID or the raw API response; returns the task exit status, or None if there was no task
+    upid = upid_from_response(upid)
+    if upid is None:
+        return None
+
+    start_time = time.time()
+    for interval in backoff_intervals():
+        status = get_task_status(proxmox_ip, token_name, token_secret, upid)
+        if status.get("status") == "stopped":
+            exitstatus = status.get("exitstatus")
+            elapsed = time.time() - start_time
+            print(f"Task {status.get('type')} {status.get('id')} on {upid_node(upid)} finished in {elapsed:.2f}s: {exitstatus}")
+            if check and not task_succeeded(exitstatus):
+                raise RuntimeError(f"Proxmox task {upid} failed: {exitstatus}")
+            return exitstatus
+        if time.time() - start_time + interval > timeout:
+            raise TimeoutError(f"Proxmox task {upid} still running after {timeout} seconds")
+        time.sleep(interval)
+
+def wait_for_vm_status(proxmox_ip, proxmox_node, token_name, token_secret, vmid, wanted_status, timeout=300):
+    # For transitions that have no task to follow, e.g. a guest shutting itself down
+    cluster_query = f"api2/json/nodes/{proxmox_node}/qemu/{vmid}/status/current"
+    start_time = time.time()
+    for interval in backoff_intervals():
+        status = get_cluster_query_output(cluster_query, proxmox_ip, token_name, token_secret)["data"].get("status")
+        if status == wanted_status:
+            print(f"VM {vmid} reached status {wanted_status} after {time.time() - start_time:.2f}s")
+            return status
+        if time.time() - start_time + interval > timeout:
+            raise TimeoutError(f"VM {vmid} did not reach status {wanted_status} within {timeout} seconds (last: {status})")
+        time.sleep(interval)
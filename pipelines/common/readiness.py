@@ -0,0 +1,56 @@
+import socket
+import time
+import requests
+from proxmox_api import post_cluster_query
+from proxmox_tasks import backoff_intervals
+
+# Overall seconds a freshly started guest gets to become reachable
+READY_DEADLINE = 600
+# Probes back off from PROBE_INITIAL to PROBE_MAX seconds between attempts
+PROBE_INITIAL = 1.0
+PROBE_MAX = 10.0
+
+def ssh_banner(host, port=22, timeout=5):
+    # The guest is only worth an SSH login once sshd answers with its "SSH-2.0-..." banner;
+    # an open port alone can still be the hypervisor NAT or a half-started daemon
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.settimeout(timeout)
+            return sock.recv(256).startswith(b"SSH-")
+    except OSError:
+        return False
+
+def guest_agent_ping(proxmox_ip, proxmox_node, token_name, token_secret, vmid):
+    try:
+        post_cluster_query(f"api2/json/nodes/{proxmox_node}/qemu/{vmid}/agent/ping", None, proxmox_ip, token_name, token_secret)
+        return True
+    except requests.exceptions.HTTPError:
+        return False
+
+def wait_for_guest(host, port=22, deadline=READY_DEADLINE, agent_ping=None):
+    # Returns the seconds it took for host to answer with an SSH banner (and for agent_ping(),
+    # when given, to return True). Raises TimeoutError once deadline has passed.
+    start_time = time.time()
+    banner = False
+    for interval in backoff_intervals(PROBE_INITIAL, PROBE_MAX):
+        banner = banner or ssh_banner(host, port)
+        if banner and (agent_ping is None or agent_ping()):
+            elapsed = time.time() - start_time
+            print(f"{host} ready after {elapsed:.1f}s")
+            return elapsed
+        if time.time() - start_time + interval > deadline:
+            waiting_for = "the guest agent" if banner else f"an SSH banner on port {port}"
+            raise TimeoutError(f"{host} not ready after {deadline} seconds, still waiting for {waiting_for}")
+        time.sleep(interval)
+
+def retry_until_ready(action, deadline=READY_DEADLINE, retry_on=(Exception,)):
+    # For the window after sshd is up but before cloud-init has installed keys or users
+    start_time = time.time()
+    for interval in backoff_intervals(PROBE_INITIAL, PROBE_MAX):
+        try:
+            return action()
+        except retry_on as e:
+            if time.time() - start_time + interval > deadline:
+                raise
+            print(f"Not ready yet ({e}), retrying in {interval:.1f}s")
+        time.sleep(interval)
@@ -0,0 +1,105 @@
+import threading
+import paramiko
+
+# Seconds between keepalive packets, so idle pooled transports survive NAT and firewall timeouts
+KEEPALIVE_INTERVAL = 30
+# Concurrent exec/SFTP/SCP channels per connection; sshd refuses more than MaxSessions (default 10)
+MAX_CHANNELS = 8
+
+_clients = {}
+_clients_lock = threading.Lock()
+_connect_locks = {}
+_keys = {}
+
+def load_private_key(key_file):
+    # Parsed once per process no matter how many hosts use it
+    with _clients_lock:
+        if key_file in _keys:
+            return _keys[key_file]
+    for key_class in (paramiko.RSAKey, paramiko.Ed25519Key, paramiko.ECDSAKey):
+        try:
+            key = key_class.from_private_key_file(key_file)
+            break
+        except paramiko.SSHException:
+            continue
+    else:
+        raise paramiko.SSHException(f"Unsupported or unreadable private key {key_file}")
+    with _clients_lock:
+        _keys[key_file] = key
+    return key
+
+def _connect_lock(client_key):
+    with _clients_lock:
+        return _connect_locks.setdefault(client_key, threading.Lock())
+
+def _is_alive(client):
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+def get_ssh_client(host, user, port=22, password=None, key_file=None):
+    # One connected SSHClient per (host, port, user), shared by every thread and step that talks
+    # to that host. A dropped transport is replaced transparently on the next call.
+    client_key = (host, port, user)
+    with _connect_lock(client_key):
+        client = _clients.get(client_key)
+        if client is not None and _is_alive(client):
+            return client
+        if client is not None:
+            client.close()
+
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            if key_file:
+                client.connect(host, port, username=user, pkey=load_private_key(key_file), allow_agent=False, look_for_keys=False)
+            else:
+                client.connect(host, port, username=user, password=password, allow_agent=False, look_for_keys=False)
+        except Exception:
+            client.close()
+            raise
+        client.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+        client.channel_slots = threading.BoundedSemaphore(MAX_CHANNELS)
+        _clients[client_key] = client
+        return client
+
+def channel_slot(client):
+    # Hold this around every exec, SFTP or SCP use of a pooled client
+    return client.channel_slots
+
+def run_command(client, command):
+    # Returns (exit status, stdout, stderr)
+    with channel_slot(client):
+        stdin, stdout, stderr = client.exec_command(command)
+        output = stdout.read().decode()
+        errors = stderr.read().decode()
+        return stdout.channel.recv_exit_status(), output, errors
+
+def stream_command(client, command, prefix):
+    # Prints output line by line as it arrives, prefixed so concurrent hosts stay readable.
+    # stderr is merged into stdout; returns the exit status.
+    with channel_slot(client):
+        channel = client.get_transport().open_session()
+        try:
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            for line in channel.makefile("r"):
+                print(f"[{prefix}] {line.rstrip()}", flush=True)
+            return channel.recv_exit_status()
+        finally:
+            channel.close()
+
+def close_ssh_client(host, user, port=22):
+    # For hosts that are going away, e.g. a temporary VM about to shut down whose IP gets reused
+    client_key = (host, port, user)
+    with _connect_lock(client_key):
+        client = _clients.pop(client_key, None)
+        if client is not None:
+            client.close()
+
+def close_ssh_clients():
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
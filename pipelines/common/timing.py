@@ -0,0 +1,112 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Every span recorded by this process: one per phase per VM or template
+_spans = []
+_spans_lock = threading.Lock()
+
+def record(phase, label, seconds, proxmox_node=None, error=None, started_at=None):
+    entry = {
+        "phase": phase,
+        "label": str(label),
+        "node": proxmox_node,
+        "started_at": round(started_at if started_at is not None else time.time() - seconds, 3),
+        "seconds": round(seconds, 3),
+        "ok": error is None,
+    }
+    if error is not None:
+        entry["error"] = error
+    with _spans_lock:
+        _spans.append(entry)
+    status = "" if error is None else " (failed)"
+    print(f"[{time.strftime('%H:%M:%S')}] {label} {phase} took {seconds:.1f}s{status}")
+
+@contextmanager
+def span(phase, label, proxmox_node=None):
+    # Times one phase (clone, upload, boot, ...) of one VM or template; failed phases are kept too
+    started_at = time.time()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record(phase, label, time.time() - started_at, proxmox_node, error, started_at)
+
+def get_spans():
+    with _spans_lock:
+        return list(_spans)
+
+def phase_totals(spans):
+    totals = {}
+    for entry in spans:
+        total = totals.setdefault(entry["phase"], {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "failed": 0})
+        total["count"] += 1
+        total["seconds"] = round(total["seconds"] + entry["seconds"], 3)
+        total["max_seconds"] = max(total["max_seconds"], entry["seconds"])
+        total["failed"] += 0 if entry["ok"] else 1
+    return totals
+
+def _write_atomically(path, text):
+    # The textfile collector and artifact archiving must never see a half-written file
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".timing-")
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+def write_report(path, pipeline, extra=None):
+    spans = sorted(get_spans(), key=lambda entry: entry["started_at"])
+    report = {
+        "pipeline": pipeline,
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "totals": phase_totals(spans),
+        "spans": spans,
+        **(extra or {}),
+    }
+    _write_atomically(path, json.dumps(report, indent=4) + "\n")
+    print(f"Wrote {len(spans)} timing spans to {path}")
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def write_prometheus(path, pipeline):
+    # node_exporter textfile format; durations of repeated phases for the same label and node add up
+    seconds, failed = {}, {}
+    for entry in get_spans():
+        key = (entry["phase"], entry["label"], entry["node"] or "")
+        seconds[key] = seconds.get(key, 0.0) + entry["seconds"]
+        failed[key] = failed.get(key, 0) + (0 if entry["ok"] else 1)
+
+    lines = [
+        "# HELP homelab_phase_seconds Seconds spent in each provisioning phase during the last run.",
+        "# TYPE homelab_phase_seconds gauge",
+    ]
+    for (phase, label, node), value in sorted(seconds.items()):
+        labels = f'pipeline="{_label_value(pipeline)}",phase="{_label_value(phase)}",label="{_label_value(label)}",node="{_label_value(node)}"'
+        lines.append(f"homelab_phase_seconds{{{labels}}} {value:.3f}")
+    lines += [
+        "# HELP homelab_phase_failures Failed attempts of each provisioning phase during the last run.",
+        "# TYPE homelab_phase_failures gauge",
+    ]
+    for (phase, label, node), value in sorted(failed.items()):
+        labels = f'pipeline="{_label_value(pipeline)}",phase="{_label_value(phase)}",label="{_label_value(label)}",node="{_label_value(node)}"'
+        lines.append(f"homelab_phase_failures{{{labels}}} {value}")
+    lines += [
+        "# HELP homelab_run_timestamp_seconds When the last run finished.",
+        "# TYPE homelab_run_timestamp_seconds gauge",
+        f'homelab_run_timestamp_seconds{{pipeline="{_label_value(pipeline)}"}} {time.time():.0f}',
+    ]
+    _write_atomically(path, "\n".join(lines) + "\n")
+    print(f"Wrote Prometheus metrics to {path}")
+
+def print_summary():
+    for phase, total in sorted(phase_totals(get_spans()).items(), key=lambda item: -item[1]["seconds"]):
+        failed = f", {total['failed']} failed" if total["failed"] else ""
+        print(f"Phase {phase}: {total['count']} runs, {total['seconds']:.1f}s total, {total['max_seconds']:.1f}s max{failed}")
@@ -0,0 +1,66 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Default concurrency budgets: image copies per node, disk imports per node/storage
+DEFAULT_LIMITS = {"upload": 2, "import": 1}
+
+class TransferScheduler:
+    # Bounded concurrency per key (a node for uploads, node/storage for disk imports) instead of one
+    # process-wide lock. Independent nodes and storages overlap; a single thin pool is not overloaded.
+    def __init__(self, limits=None, bandwidth_limit=None):
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        # Bytes per second per node shared by all uploads to it; None means uncapped
+        self.bandwidth_limit = bandwidth_limit
+        self.waits = {}
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._next_send = {}
+
+    def _semaphore(self, kind, key):
+        with self._lock:
+            if (kind, key) not in self._semaphores:
+                self._semaphores[(kind, key)] = threading.BoundedSemaphore(self.limits[kind])
+            return self._semaphores[(kind, key)]
+
+    @contextmanager
+    def slot(self, kind, key, label):
+        semaphore = self._semaphore(kind, key)
+        queued_at = time.time()
+        semaphore.acquire()
+        waited = time.time() - queued_at
+        with self._lock:
+            self.waits.setdefault(label, {})
+            self.waits[label][kind] = self.waits[label].get(kind, 0) + waited
+        if waited >= 1:
+            print(f"{label} waited {waited:.1f}s for an {kind} slot on {key}")
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def throttle(self, key, nbytes):
+        # Called after nbytes went out to key; sleeps long enough to keep the average under the cap
+        if not self.bandwidth_limit or nbytes <= 0:
+            return
+        with self._lock:
+            now = time.time()
+            next_send = max(now, self._next_send.get(key, now)) + nbytes / self.bandwidth_limit
+            self._next_send[key] = next_send
+        if next_send > now:
+            time.sleep(next_send - now)
+
+    def scp_progress(self, key):
+        # SCPClient progress callback reporting cumulative bytes; throttles on the delta
+        sent_so_far = {}
+
+        def progress(filename, size, sent):
+            delta = sent - sent_so_far.get(filename, 0)
+            sent_so_far[filename] = sent
+            self.throttle(key, delta)
+        return progress
+
+    def report(self):
+        for label in sorted(self.waits):
+            waits = ", ".join(f"{kind} {seconds:.1f}s" for kind, seconds in sorted(self.waits[label].items()))
+            print(f"Queue wait for {label}: {waits}")
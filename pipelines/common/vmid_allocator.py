@@ -0,0 +1,64 @@
+import threading
+import requests
+from cluster_resources import SNAPSHOT_TTL, get_cluster_snapshot
+
+# VMIDs this process has already reserved, so its own threads never race each other
+_claimed = set()
+_claimed_lock = threading.Lock()
+
+def free_intervals(used_vmids, vmid_start, vmid_end):
+    # Sorted, non-overlapping (first, last) ranges of VMIDs not present in used_vmids
+    intervals = []
+    cursor = vmid_start
+    for vmid in sorted(v for v in used_vmids if vmid_start <= v <= vmid_end):
+        if vmid > cursor:
+            intervals.append((cursor, vmid - 1))
+        cursor = max(cursor, vmid + 1)
+    if cursor <= vmid_end:
+        intervals.append((cursor, vmid_end))
+    return intervals
+
+def iter_free_vmids(intervals):
+    for first, last in intervals:
+        yield from range(first, last + 1)
+
+def is_vmid_conflict(error):
+    # pmxcfs creates the guest config with create-or-fail semantics; losing that race surfaces as
+    # "already exists", either in the API response or as the exit status of a failed task
+    response = getattr(error, "response", None)
+    details = f"{error} {getattr(response, 'reason', '')} {getattr(response, 'text', '')}"
+    return "already exists" in details
+
+def allocate_vmid(proxmox_ip, token_name, token_secret, vmid_start, vmid_end, reserve, attempts=5):
+    # reserve(vmid) must create the guest (create or clone), wait for its task, and fail if the VMID is taken.
+    # Returns (vmid, reserve's return value).
+    vmid_start = int(vmid_start)
+    vmid_end = int(vmid_end)
+    for attempt in range(attempts):
+        # The first pass may use a cached snapshot; after losing races always look again
+        max_age = SNAPSHOT_TTL if attempt == 0 else 0
+        snapshot = get_cluster_snapshot(proxmox_ip, token_name, token_secret, max_age=max_age)
+        with _claimed_lock:
+            used_vmids = set(snapshot["by_vmid"]) | _claimed
+        intervals = free_intervals(used_vmids, vmid_start, vmid_end)
+        if not intervals:
+            break
+
+        for vmid in iter_free_vmids(intervals):
+            with _claimed_lock:
+                if vmid in _claimed:
+                    continue
+                _claimed.add(vmid)
+            try:
+                result = reserve(vmid)
+            except (requests.exceptions.HTTPError, RuntimeError) as e:
+                with _claimed_lock:
+                    _claimed.discard(vmid)
+                if not is_vmid_conflict(e):
+                    raise
+                print(f"VMID {vmid} was taken by another build, trying the next free one")
+                continue
+            # Stays in _claimed, so later allocations can keep using the cached snapshot
+            return vmid, result
+
+    raise ValueError("No available VMID found in the specified range")
@@ -0,0 +1,103 @@
+import json
+import re
+import requests
+from proxmox_api import delete_cluster_query, get_cluster_query_output, post_cluster_query, put_cluster_query
+from proxmox_tasks import wait_for_task
+from cluster_resources import get_cluster_snapshot, invalidate_cluster_snapshot, lookup_by_name, newest_template, vm_tags
+
+# Warm clones are stopped, poolless copies of a template tagged warm.<template> and
+# warm-from.<template VMID>; a clone of a template that has since been rebuilt is stale
+WARM_TAG_PREFIX = "warm."
+WARM_SOURCE_PREFIX = "warm-from."
+CLAIMED_TAG = "warm-claimed"
+
+def warm_tag(template_name):
+    return f"{WARM_TAG_PREFIX}{re.sub(r'[^a-zA-Z0-9]', '-', template_name)}".lower()
+
+def warm_source_tag(template_vmid):
+    return f"{WARM_SOURCE_PREFIX}{template_vmid}"
+
+def warm_source(vm):
+    # VMID of the template the clone was made from, None for clones made before it was recorded
+    for tag in vm_tags(vm):
+        if tag.startswith(WARM_SOURCE_PREFIX) and tag[len(WARM_SOURCE_PREFIX):].isdigit():
+            return int(tag[len(WARM_SOURCE_PREFIX):])
+    return None
+
+def current_templates(proxmox_ip, token_name, token_secret, template_name):
+    # Node -> VMID of the template a fresh clone on that node would be made from
+    snapshot = get_cluster_snapshot(proxmox_ip, token_name, token_secret)
+    current = {}
+    for proxmox_node in sorted({vm["node"] for vm in lookup_by_name(snapshot, template_name, template=True)}):
+        current[proxmox_node] = newest_template(proxmox_ip, token_name, token_secret, template_name, proxmox_node)["vmid"]
+    return current
+
+def warm_vm_name(template_name):
+    return f"warm-{re.sub(r'[^a-zA-Z0-9-]', '-', template_name)}"
+
+def load_targets(targets_file):
+    # {"ubuntu-22": 3, ...}: how many warm clones to keep per template
+    with open(targets_file) as f:
+        targets = json.load(f)
+    return {template_name: int(count) for template_name, count in targets.items()}
+
+def list_warm_vms(snapshot, template_name, proxmox_node=None, current=None):
+    # With current (node -> template VMID from current_templates), only clones of those templates
+    tag = warm_tag(template_name)
+    vms = [
+        vm for vm in snapshot["by_vmid"].values()
+        if vm.get("template", 0) != 1 and not vm.get("lock") and tag in vm_tags(vm)
+        and (proxmox_node is None or vm["node"] == proxmox_node)
+        and (current is None or warm_source(vm) == current.get(vm["node"]))
+    ]
+    return sorted(vms, key=lambda vm: vm["vmid"])
+
+def stale_warm_vms(snapshot, template_name, current):
+    fresh = {vm["vmid"] for vm in list_warm_vms(snapshot, template_name, current=current)}
+    return [vm for vm in list_warm_vms(snapshot, template_name) if vm["vmid"] not in fresh]
+
+def warm_deficit(snapshot, targets, current_by_template=None):
+    # Template -> number of current clones missing from its target
+    deficit = {}
+    for template_name, target in targets.items():
+        current = None if current_by_template is None else current_by_template.get(template_name, {})
+        missing = target - len(list_warm_vms(snapshot, template_name, current=current))
+        if missing > 0:
+            deficit[template_name] = missing
+    return deficit
+
+def claim_warm_vm(proxmox_ip, token_name, token_secret, template_name, proxmox_nodes=None):
+    # Takes one warm clone out of the pool and returns its cluster/resources entry, or None when
+    # the pool is empty. The retag carries the config digest, so if two builds go for the same
+    # clone Proxmox rejects the slower one and it moves on to the next clone.
+    snapshot = get_cluster_snapshot(proxmox_ip, token_name, token_secret, max_age=0)
+    # Clones of a template that has been rebuilt since are left for refill to discard
+    current = current_templates(proxmox_ip, token_name, token_secret, template_name)
+    for vm in list_warm_vms(snapshot, template_name, current=current):
+        if proxmox_nodes is not None and vm["node"] not in proxmox_nodes:
+            continue
+        endpoint = f"api2/json/nodes/{vm['node']}/qemu/{vm['vmid']}/config"
+        try:
+            config = get_cluster_query_output(endpoint, proxmox_ip, token_name, token_secret)["data"]
+            if warm_tag(template_name) not in vm_tags(config) or warm_source(config) != current[vm["node"]]:
+                continue
+            put_cluster_query(endpoint, {"tags": CLAIMED_TAG, "digest": config["digest"]}, proxmox_ip, token_name, token_secret)
+        except requests.exceptions.HTTPError as e:
+            print(f"Warm clone {vm['vmid']} was claimed by another build ({e}), trying the next one")
+            continue
+        invalidate_cluster_snapshot(proxmox_ip)
+        print(f"Claimed warm clone {vm['vmid']} of {template_name} on {vm['node']}")
+        return vm
+    return None
+
+def discard_warm_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid):
+    # For a claimed clone whose build failed part way. It may already be pooled, renamed, resized
+    # or running, so it is no longer a pristine copy to put back; the next refill replaces it.
+    status = get_cluster_query_output(f"api2/json/nodes/{proxmox_node}/qemu/{vmid}/status/current", proxmox_ip, token_name, token_secret)["data"]
+    if status.get("status") != "stopped":
+        response = post_cluster_query(f"api2/json/nodes/{proxmox_node}/qemu/{vmid}/status/stop", None, proxmox_ip, token_name, token_secret)
+        wait_for_task(proxmox_ip, token_name, token_secret, response)
+    response = delete_cluster_query(f"api2/json/nodes/{proxmox_node}/qemu/{vmid}?destroy-unreferenced-disks=1&purge=1", proxmox_ip, token_name, token_secret)
+    wait_for_task(proxmox_ip, token_name, token_secret, response)
+    invalidate_cluster_snapshot(proxmox_ip)
+    print(f"Discarded warm clone {vmid} on {proxmox_node}")
@@ -1,23 +1,51 @@
 import os
 import requests
-from requests_toolbelt.multipart.encoder import MultipartEncoder
+from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
 import argparse
+import hashlib
+import json
+import sys
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue
 
-def download_iso(iso_url, output_path):
-    response = requests.get(iso_url, stream=True)
-    if response.status_code == 200:
-        with open(output_path, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-        print(f"Downloaded ISO to {output_path}")
-    else:
-        response.raise_for_status()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from proxmox_api import get_session, api_url, delete_cluster_query, get_cluster_query_output, post_cluster_query
+from proxmox_tasks import wait_for_task
+from downloads import DEFAULT_CONNECTIONS, default_checksums_url, download_file, expected_sha256, get_download_session, probe
+
+# Relay mode holds at most RELAY_BUFFER_CHUNKS * RELAY_CHUNK_SIZE bytes of the ISO in memory
+RELAY_CHUNK_SIZE = 1024 * 1024
+RELAY_BUFFER_CHUNKS = 32
+# Server-side fetches of multi-GB ISOs can legitimately take a long time
+DOWNLOAD_URL_TIMEOUT = 3 * 3600
+
+# Fan-out records placements from several threads
+_index_lock = threading.Lock()
+
+def download_iso(iso_url, output_path, connections=DEFAULT_CONNECTIONS, sha256=None, checksum_url=None):
+    # Ranged, resumable download; an interrupted run picks up from {output_path}.state.json
+    if not sha256:
+        sha256 = expected_sha256(iso_url, checksum_url or default_checksums_url(iso_url))
+    digest = download_file(iso_url, output_path, connections=connections, expected_digest=sha256)
+    print(f"Downloaded ISO to {output_path} (sha256 {digest}{', verified' if sha256 else ''})")
+    return digest
 
-def upload_iso_to_proxmox(proxmox_ip, node, storage, iso_path, token_name, token_secret, chunk_size=1024*1024):
-    api_url = f"https://{proxmox_ip}:8006/api2/json/nodes/{node}/storage/{storage}/upload"
-    headers = {
-        "Authorization": f"PVEAPIToken={token_name}={token_secret}"
-    }
+def upload_progress(label, step=10):
+    # MultipartEncoderMonitor callback printing every `step` percent, so concurrent uploads stay readable
+    state = {"next": step}
+
+    def callback(monitor):
+        percent = monitor.bytes_read * 100 // max(monitor.len, 1)
+        if percent >= state["next"]:
+            print(f"{label}: {percent}% ({monitor.bytes_read}/{monitor.len} bytes)")
+            state["next"] = (percent // step + 1) * step
+    return callback
+
+def upload_iso_to_proxmox(proxmox_ip, node, storage, iso_path, token_name, token_secret, chunk_size=1024*1024, show_progress=False):
+    upload_url = api_url(proxmox_ip, f"api2/json/nodes/{node}/storage/{storage}/upload")
+    session = get_session(proxmox_ip, token_name, token_secret)
 
     with open(iso_path, 'rb') as file:
         encoder = MultipartEncoder(
@@ -26,23 +54,304 @@ def upload_iso_to_proxmox(proxmox_ip, node, storage, iso_path, token_name, token
                 'filename': (os.path.basename(iso_path), file, 'application/octet-stream')
             }
         )
+        if show_progress:
+            encoder = MultipartEncoderMonitor(encoder, upload_progress(f"{node}/{storage}"))
         
-        headers['Content-Type'] = encoder.content_type
+        headers = {'Content-Type': encoder.content_type}
 
-        response = requests.post(api_url, headers=headers, data=encoder, verify=False)
-        
-        if response.status_code == 200:
-            print(f"Uploaded ISO {iso_path} to {node}/{storage}")
-        else:
-            response.raise_for_status()
+        response = session.post(upload_url, headers=headers, data=encoder, timeout=(5, 600))
+        response.raise_for_status()
+
+    # PVE 7+ answers with the UPID of an imgcopy task that moves the file into place
+    wait_for_task(proxmox_ip, token_name, token_secret, response.json())
+    print(f"Uploaded ISO {iso_path} to {node}/{storage}")
+
+class RelayBody:
+    # File-like multipart body: requests reads it while a download thread fills a bounded queue.
+    # A full queue blocks the download, so the slower side sets the pace and memory stays flat.
+    def __init__(self, iso_url, filename, size, fields):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        preamble = b""
+        for name, value in fields.items():
+            preamble += f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        preamble += (
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="filename"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode()
+        self.epilogue = f"\r\n--{self.boundary}--\r\n".encode()
+        self.iso_url = iso_url
+        self.size = size
+        self.length = len(preamble) + size + len(self.epilogue)
+        self.digest = hashlib.sha256()
+        self.relayed = 0
+        self.error = None
+        self.chunks = Queue(maxsize=RELAY_BUFFER_CHUNKS)
+        self.buffer = preamble
+        self.offset = 0
+        self.finished = False
+
+    def __len__(self):
+        # Lets requests send a Content-Length; pveproxy does not take chunked uploads
+        return self.length
+
+    def start(self):
+        threading.Thread(target=self.download, daemon=True).start()
+
+    def download(self):
+        try:
+            with get_download_session().get(self.iso_url, stream=True, timeout=(10, 120)) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=RELAY_CHUNK_SIZE):
+                    self.chunks.put(chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.chunks.put(None)
+
+    def next_piece(self):
+        chunk = self.chunks.get()
+        if chunk is None:
+            if self.error is not None:
+                raise self.error
+            if self.relayed != self.size:
+                raise IOError(f"{self.iso_url} ended after {self.relayed} of {self.size} bytes")
+            self.finished = True
+            return self.epilogue
+        self.digest.update(chunk)
+        self.relayed += len(chunk)
+        return chunk
+
+    def read(self, size=-1):
+        # Short reads are fine for http.client; it keeps reading until it gets b""
+        while self.offset >= len(self.buffer):
+            if self.finished:
+                return b""
+            self.buffer = self.next_piece()
+            self.offset = 0
+        end = len(self.buffer) if size is None or size < 0 else self.offset + size
+        data = self.buffer[self.offset:end]
+        self.offset += len(data)
+        return data
+
+def relay_iso_to_proxmox(proxmox_ip, node, storage, iso_url, token_name, token_secret, sha256=None):
+    # Streams the ISO from its URL into the Proxmox upload without touching local disk
+    info = probe(iso_url)
+    if not info["size"]:
+        return None
+    filename = os.path.basename(iso_url)
+    fields = {"content": "iso"}
+    if sha256:
+        # Checked again by the imgcopy task Proxmox runs after the upload; it fails on mismatch
+        fields["checksum"] = sha256
+        fields["checksum-algorithm"] = "sha256"
+    body = RelayBody(iso_url, filename, info["size"], fields)
+    upload_url = api_url(proxmox_ip, f"api2/json/nodes/{node}/storage/{storage}/upload")
+    session = get_session(proxmox_ip, token_name, token_secret)
+
+    print(f"Relaying {iso_url} ({info['size']} bytes) to {node}/{storage}")
+    body.start()
+    response = session.post(upload_url, headers={"Content-Type": body.content_type}, data=body, timeout=(5, 600))
+    response.raise_for_status()
+    # The file only lands in template/iso once the imgcopy task is done
+    wait_for_task(proxmox_ip, token_name, token_secret, response.json())
+
+    digest = body.digest.hexdigest()
+    if sha256 and sha256.lower() != digest:
+        delete_cluster_query(f"api2/json/nodes/{node}/storage/{storage}/content/{storage}:iso/{filename}", proxmox_ip, token_name, token_secret)
+        raise ValueError(f"Checksum mismatch for {iso_url}: expected {sha256}, got {digest}")
+    print(f"Relayed ISO {filename} to {node}/{storage} (sha256 {digest}{', verified' if sha256 else ''})")
+    return digest
+
+def load_iso_index(index_file):
+    try:
+        with open(index_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_iso_index(index_file, index):
+    tmp_file = f"{index_file}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(index, f, indent=4, sort_keys=True)
+    os.replace(tmp_file, index_file)
+
+def record_iso(index, iso_url, filename, size, sha256, node, storage):
+    # Index is keyed by URL and remembers which node/storage pairs already hold the file
+    with _index_lock:
+        entry = index.setdefault(iso_url, {"filename": filename, "targets": []})
+        entry["size"] = size
+        if sha256:
+            entry["sha256"] = sha256
+        target = f"{node}/{storage}"
+        if target not in entry["targets"]:
+            entry["targets"].append(target)
+
+def list_storage_isos(proxmox_ip, node, storage, token_name, token_secret):
+    cluster_query = f"api2/json/nodes/{node}/storage/{storage}/content"
+    content = get_cluster_query_output(cluster_query, proxmox_ip, token_name, token_secret, params={"content": "iso"})["data"]
+    return {item["volid"]: item for item in content}
+
+def iso_volid(storage, filename):
+    return f"{storage}:iso/{filename}"
+
+def stored_iso_size(proxmox_ip, node, storage, filename, token_name, token_secret):
+    # Only called once the upload or download task has finished, so a missing file is a failure
+    volid = iso_volid(storage, filename)
+    size = list_storage_isos(proxmox_ip, node, storage, token_name, token_secret).get(volid, {}).get("size")
+    if size is None:
+        raise RuntimeError(f"{volid} is not on {node} after the transfer finished")
+    return size
+
+def fetch_iso_on_node(proxmox_ip, node, storage, iso_url, filename, token_name, token_secret, sha256=None):
+    # The node pulls the ISO itself; nothing goes through this agent
+    cluster_query = f"api2/json/nodes/{node}/storage/{storage}/download-url"
+    data = {"url": iso_url, "content": "iso", "filename": filename}
+    if sha256:
+        data["checksum"] = sha256
+        data["checksum-algorithm"] = "sha256"
+    print(f"Asking {node} to fetch {iso_url} into {storage}")
+    response = post_cluster_query(cluster_query, data, proxmox_ip, token_name, token_secret)
+    wait_for_task(proxmox_ip, token_name, token_secret, response, timeout=DOWNLOAD_URL_TIMEOUT)
+
+def transfer_iso(proxmox_ip, node, storage, iso_url, token_name, token_secret, mode, sha256=None, checksum_url=None, connections=DEFAULT_CONNECTIONS):
+    # Moves the ISO onto node/storage with the agent in the data path (relay or stage). Returns the sha256.
+    if mode == "relay":
+        sha256 = sha256 or expected_sha256(iso_url, checksum_url or default_checksums_url(iso_url))
+        digest = relay_iso_to_proxmox(proxmox_ip, node, storage, iso_url, token_name, token_secret, sha256)
+        if digest:
+            return digest
+        print(f"{iso_url} does not report its size, falling back to staging it in /tmp")
+
+    # Extract the filename from the URL and set the path in /tmp
+    iso_filename = os.path.basename(iso_url)
+    iso_path = f"/tmp/{iso_filename}"
+    
+    print(f"Running download_iso({iso_url})")
+    digest = download_iso(iso_url, iso_path, connections, sha256, checksum_url)
+    
+    print(f"Running upload_iso_to_proxmox {proxmox_ip}, {node}, {storage}, {iso_path}")
+    upload_iso_to_proxmox(proxmox_ip, node, storage, iso_path, token_name, token_secret)
+    
+    os.remove(iso_path)
+    print(f"Removed ISO from {iso_path}")
+    return digest
+
+def iso_present(proxmox_ip, node, storage, iso_url, token_name, token_secret, index, sha256=None, upstream_size=None):
+    # True when node/storage already holds a file matching iso_url, False when it has none.
+    # A same-named file that does not match is an error rather than something to overwrite.
+    filename = os.path.basename(iso_url)
+    volid = iso_volid(storage, filename)
+    existing = list_storage_isos(proxmox_ip, node, storage, token_name, token_secret).get(volid)
+    if existing is None:
+        return False
+
+    known = index.get(iso_url)
+    if known and known.get("size") == existing.get("size") and (not sha256 or known.get("sha256") in (None, sha256.lower())):
+        print(f"{volid} on {node} already matches the index, nothing to do")
+        record_iso(index, iso_url, filename, existing.get("size"), known.get("sha256"), node, storage)
+        return True
+    upstream_size = upstream_size or probe(iso_url)["size"]
+    if upstream_size and upstream_size == existing.get("size"):
+        print(f"{volid} on {node} has the same size as {iso_url}, treating it as present")
+        record_iso(index, iso_url, filename, upstream_size, sha256, node, storage)
+        return True
+    raise ValueError(f"{volid} already exists on {node} but does not match {iso_url}; remove it or rename the ISO")
+
+def sync_iso(proxmox_ip, node, storage, iso_url, token_name, token_secret, index, sha256=None, checksum_url=None, connections=DEFAULT_CONNECTIONS):
+    # Returns "present" when the storage already holds a matching file, otherwise "fetched" or "relayed"
+    if iso_present(proxmox_ip, node, storage, iso_url, token_name, token_secret, index, sha256):
+        return "present"
+
+    filename = os.path.basename(iso_url)
+    known = index.get(iso_url)
+    sha256 = sha256 or (known or {}).get("sha256") or expected_sha256(iso_url, checksum_url or default_checksums_url(iso_url))
+    try:
+        fetch_iso_on_node(proxmox_ip, node, storage, iso_url, filename, token_name, token_secret, sha256)
+        size = stored_iso_size(proxmox_ip, node, storage, filename, token_name, token_secret)
+        record_iso(index, iso_url, filename, size, sha256, node, storage)
+        return "fetched"
+    except (requests.exceptions.HTTPError, RuntimeError) as e:
+        print(f"{node} could not fetch {iso_url} itself ({e}), relaying it through this agent")
+
+    digest = transfer_iso(proxmox_ip, node, storage, iso_url, token_name, token_secret, "relay", sha256, checksum_url, connections)
+    size = stored_iso_size(proxmox_ip, node, storage, filename, token_name, token_secret)
+    record_iso(index, iso_url, filename, size, digest, node, storage)
+    return "relayed"
+
+def parse_targets(targets, default_storage):
+    # "node" or "node:storage", comma separated
+    parsed = []
+    for target in targets.split(","):
+        target = target.strip()
+        if not target:
+            continue
+        node, _, storage = target.partition(":")
+        if (node, storage or default_storage) not in parsed:
+            parsed.append((node, storage or default_storage))
+    return parsed
+
+def distribute_iso(proxmox_ip, targets, iso_url, token_name, token_secret, index, concurrency, sha256=None, checksum_url=None, connections=DEFAULT_CONNECTIONS):
+    # Downloads the ISO once to /tmp and uploads it to every (node, storage) in targets that lacks it.
+    # Returns {"present": [...], "uploaded": [...], "failed": {target: error}}.
+    results = {"present": [], "uploaded": [], "failed": {}}
+    upstream_size = probe(iso_url)["size"]
+    missing = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(iso_present, proxmox_ip, node, storage, iso_url, token_name, token_secret, index, sha256, upstream_size): (node, storage) for node, storage in targets}
+        for future in as_completed(futures):
+            node, storage = futures[future]
+            try:
+                if future.result():
+                    results["present"].append(f"{node}/{storage}")
+                else:
+                    missing.append((node, storage))
+            except Exception as e:
+                results["failed"][f"{node}/{storage}"] = str(e)
+    if not missing:
+        return results
+
+    iso_filename = os.path.basename(iso_url)
+    iso_path = f"/tmp/{iso_filename}"
+    print(f"Running download_iso({iso_url}) once for {len(missing)} targets")
+    digest = download_iso(iso_url, iso_path, connections, sha256, checksum_url)
+    size = os.path.getsize(iso_path)
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(upload_iso_to_proxmox, proxmox_ip, node, storage, iso_path, token_name, token_secret, show_progress=True): (node, storage) for node, storage in missing}
+            for future in as_completed(futures):
+                node, storage = futures[future]
+                try:
+                    # The upload has waited for its imgcopy task, so the storage listing is final
+                    future.result()
+                    stored_size = stored_iso_size(proxmox_ip, node, storage, iso_filename, token_name, token_secret)
+                    if stored_size != size:
+                        raise RuntimeError(f"{node}/{storage} holds {stored_size} bytes of {iso_filename}, expected {size}")
+                    results["uploaded"].append(f"{node}/{storage}")
+                    record_iso(index, iso_url, iso_filename, size, digest, node, storage)
+                except Exception as e:
+                    print(f"Upload to {node}/{storage} failed: {e}")
+                    results["failed"][f"{node}/{storage}"] = str(e)
+    finally:
+        os.remove(iso_path)
+        print(f"Removed ISO from {iso_path}")
+    return results
 
 def main():
     parser = argparse.ArgumentParser(description="Download and upload an ISO to Proxmox")
     parser.add_argument("--proxmox_ip", required=True, help="Proxmox IP address")
-    parser.add_argument("--proxmox_node", required=True, help="Proxmox node")
+    parser.add_argument("--proxmox_node", help="Proxmox node")
+    parser.add_argument("--targets", help="Comma separated node[:storage] list to fan the ISO out to; downloads once, always staged in /tmp, so --mode does not apply")
+    parser.add_argument("--storage", default="local", help="Storage to upload to when a target does not name one")
+    parser.add_argument("--concurrency", type=int, default=4, help="Max number of targets uploaded to at once")
     parser.add_argument("--iso_url", required=True, help="URL to get the iso from")
     parser.add_argument("--token_name", required=True, help="Proxmox API token name")
     parser.add_argument("--token_secret", required=True, help="Proxmox API token secret")
+    parser.add_argument("--connections", type=int, default=DEFAULT_CONNECTIONS, help="Parallel range requests for the download")
+    parser.add_argument("--sha256", help="Expected sha256 of the ISO")
+    parser.add_argument("--checksum_url", help="SHA256SUMS file listing the ISO; defaults to the one next to --iso_url")
+    parser.add_argument("--mode", choices=["sync", "relay", "stage"], default="stage", help="sync: skip ISOs already on the storage and let the node fetch new ones, relaying if it cannot; relay: stream the download into the upload; stage: download to /tmp first")
+    parser.add_argument("--index_file", default="iso-index.json", help="Local index of ISO checksums and where they were placed, used by sync mode and --targets")
     
     args = parser.parse_args()
 
@@ -50,21 +359,37 @@ def main():
     proxmox_node = args.proxmox_node
     token_name = args.token_name
     token_secret = args.token_secret
-    storage = "local"
+    storage = args.storage
     iso_url = args.iso_url
+    if not (proxmox_node or args.targets):
+        parser.error("Give --proxmox_node or --targets")
 
-    # Extract the filename from the URL and set the path in /tmp
-    iso_filename = os.path.basename(iso_url)
-    iso_path = f"/tmp/{iso_filename}"
-    
-    print(f"Running download_iso({iso_url})")
-    download_iso(iso_url, iso_path)
-    
-    print(f"Running upload_iso_to_proxmox {proxmox_ip}, {proxmox_node}, {storage}, {iso_path}, {token_name}, {token_secret}")
-    upload_iso_to_proxmox(proxmox_ip, proxmox_node, storage, iso_path, token_name, token_secret)
-    
-    os.remove(iso_path)
-    print(f"Removed ISO from {iso_path}")
+    if args.targets:
+        if args.mode != "stage":
+            print(f"Warning: --mode {args.mode} does not apply to --targets; the ISO is staged in /tmp once and uploaded to each target")
+        index = load_iso_index(args.index_file)
+        try:
+            results = distribute_iso(proxmox_ip, parse_targets(args.targets, storage), iso_url, token_name, token_secret, index, args.concurrency, args.sha256, args.checksum_url, args.connections)
+        finally:
+            save_iso_index(args.index_file, index)
+        print(f"Already present on: {', '.join(sorted(results['present'])) or 'none'}")
+        print(f"Uploaded to: {', '.join(sorted(results['uploaded'])) or 'none'}")
+        if results["failed"]:
+            for target, error in sorted(results["failed"].items()):
+                print(f"Failed on {target}: {error}")
+            raise SystemExit(f"Failed to place the ISO on {len(results['failed'])} targets")
+        return
+
+    if args.mode == "sync":
+        index = load_iso_index(args.index_file)
+        try:
+            result = sync_iso(proxmox_ip, proxmox_node, storage, iso_url, token_name, token_secret, index, args.sha256, args.checksum_url, args.connections)
+        finally:
+            save_iso_index(args.index_file, index)
+        print(f"{os.path.basename(iso_url)} on {proxmox_node}/{storage}: {result}")
+        return
+
+    transfer_iso(proxmox_ip, proxmox_node, storage, iso_url, token_name, token_secret, args.mode, args.sha256, args.checksum_url, args.connections)
 
 if __name__ == "__main__":
     main()
@@ -1,19 +1,17 @@
 import argparse
 import json
-import paramiko
 import re
 from ipaddress import ip_network, ip_address
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def get_network_info(master_ip, ssh_key):
-    key = paramiko.RSAKey(file_obj=ssh_key)
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(master_ip, username='ubuntu', pkey=key)
-    
-    stdin, stdout, stderr = ssh.exec_command('ip addr show')
-    network_info = stdout.read().decode()
-    ssh.close()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from ssh_pool import channel_slot, close_ssh_clients, get_ssh_client, run_command, stream_command
+
+def get_network_info(master_ip, ssh_key_path):
+    ssh = get_ssh_client(master_ip, 'ubuntu', key_file=ssh_key_path)
+    exit_status, network_info, errors = run_command(ssh, 'ip addr show')
     
     ip_addresses = []
     for line in network_info.splitlines():
@@ -34,11 +32,8 @@ def find_matching_ip(vm_ipv4, network_info):
             return ip
     return None
 
-def scp_directory_to_remote(ssh_key, path_to_scp, remote_host, username='ubuntu'):
-    key = paramiko.RSAKey(file_obj=ssh_key)
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(remote_host, username=username, pkey=key)
+def scp_directory_to_remote(ssh_key_path, path_to_scp, remote_host, username='ubuntu'):
+    ssh = get_ssh_client(remote_host, username, key_file=ssh_key_path)
     
     put_path = f"/home/ubuntu"
     
@@ -49,39 +44,97 @@ def scp_directory_to_remote(ssh_key, path_to_scp, remote_host, username='ubuntu'
             file_path = os.path.join(root, file)
             print(file_path)
     
-    scp = paramiko.SFTPClient.from_transport(ssh.get_transport())
-    
-    # Copy the specific files (install.sh and Dockerfile in this case)
-    scp.put(f"{path_to_scp}/install.sh", f"{put_path}/install.sh")
-    scp.put(f"{path_to_scp}/Dockerfile", f"{put_path}/Dockerfile")
-    
-    scp.close()
-    ssh.close()
+    with channel_slot(ssh):
+        scp = ssh.open_sftp()
+        
+        # Copy the specific files (install.sh and Dockerfile in this case)
+        scp.put(f"{path_to_scp}/install.sh", f"{put_path}/install.sh")
+        scp.put(f"{path_to_scp}/Dockerfile", f"{put_path}/Dockerfile")
+        
+        scp.close()
 
 def run_remote_command(ssh_key_path, remote_host, master_ip, agent_name, secret, docker_registry, username='ubuntu'):
     makeexec = "chmod +x /home/ubuntu/install.sh"
     command = f"sudo /home/ubuntu/install.sh -i {master_ip} -p 8080 -n {agent_name} -s {secret} -d {docker_registry}"
-    key = paramiko.RSAKey.from_private_key_file(ssh_key_path)
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(remote_host, username=username, pkey=key)
-    stdin, stdout, stderr = ssh.exec_command(makeexec)
-    stdin, stdout, stderr = ssh.exec_command(command)
-    print(stdout.read().decode())
-    print(stderr.read().decode())
-    ssh.close()
+    # Same pooled connection the files were copied over
+    ssh = get_ssh_client(remote_host, username, key_file=ssh_key_path)
+    run_command(ssh, makeexec)
+    # Streamed rather than read at the end, so a hung install is visible while it happens
+    exit_status = stream_command(ssh, command, agent_name)
+    if exit_status != 0:
+        raise RuntimeError(f"install.sh failed on {remote_host} for agent {agent_name} ({exit_status})")
+
+def load_fleet(fleet_file, secrets=None):
+    # JSON list of {"agent_name", "metadata_file", "secret_file"}; paths are relative to the fleet file.
+    # secret_file can be left out when secrets (from generate-agent.py --secrets-file) has the agent.
+    base_dir = os.path.dirname(os.path.abspath(fleet_file))
+    with open(fleet_file) as f:
+        entries = json.load(f)
+    fleet = []
+    for entry in entries:
+        with open(os.path.join(base_dir, entry['metadata_file'])) as f:
+            metadata = json.load(f)
+        if secrets and entry['agent_name'] in secrets:
+            secret = secrets[entry['agent_name']]
+        else:
+            with open(os.path.join(base_dir, entry['secret_file'])) as f:
+                secret = f.read().strip()
+        fleet.append({"agent_name": entry['agent_name'], "vm_ipv4": metadata['vm_ipv4'], "secret": secret})
+    return fleet
+
+def provision_agent(ssh_key_path, scp_dir, network_info, agent, docker_registry):
+    master_ip = find_matching_ip(agent['vm_ipv4'], network_info)
+    if not master_ip:
+        raise ValueError(f"No master IP in the same subnet as {agent['vm_ipv4']}")
+    scp_directory_to_remote(ssh_key_path, scp_dir, agent['vm_ipv4'])
+    run_remote_command(ssh_key_path, agent['vm_ipv4'], master_ip, agent['agent_name'], agent['secret'], docker_registry)
+    return agent['agent_name']
+
+def provision_fleet(ssh_key_path, scp_dir, master_host, fleet, docker_registry, concurrency):
+    # The master's interfaces are read once and shared by every agent
+    network_info = get_network_info(master_host, ssh_key_path)
+    provisioned, failures = [], {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(provision_agent, ssh_key_path, scp_dir, network_info, agent, docker_registry): agent for agent in fleet}
+        for future in as_completed(futures):
+            agent = futures[future]
+            try:
+                provisioned.append(future.result())
+                print(f"Agent {agent['agent_name']} provisioned on {agent['vm_ipv4']} ({len(provisioned)}/{len(fleet)})")
+            except Exception as e:
+                print(f"Agent {agent['agent_name']} on {agent['vm_ipv4']} failed: {e}")
+                failures[agent['agent_name']] = str(e)
+    return sorted(provisioned), failures
 
 def main():
     parser = argparse.ArgumentParser(description='Provision a Jenkins agent.')
-    parser.add_argument('--secret-file', required=True, help='Path to the secret file.')
-    parser.add_argument('--metadata-file', required=True, help='Path to the VM metadata JSON file.')
+    parser.add_argument('--secret-file', help='Path to the secret file.')
+    parser.add_argument('--metadata-file', help='Path to the VM metadata JSON file.')
     parser.add_argument('--ssh-key-file', required=True, help='Path to the SSH private key file.')
     parser.add_argument('--scp-dir', required=True, help='Path to the directory to SCP.')
-    parser.add_argument('--agent-name', required=True, help='Name of the Jenkins agent.')
+    parser.add_argument('--agent-name', help='Name of the Jenkins agent.')
+    parser.add_argument('--fleet-file', help='JSON list of agent_name/metadata_file/secret_file entries to provision together.')
+    parser.add_argument('--secrets-file', help='JSON file of {agent: secret} from generate-agent.py --agent-names, used by --fleet-file.')
+    parser.add_argument('--concurrency', type=int, default=5, help='Max number of agents to provision at once in fleet mode.')
     parser.add_argument('--master-ip', required=True, help='IP address of the Jenkins master.')
     parser.add_argument('--docker-registry', required=True, help='URL of docker registry to trust.')
 
     args = parser.parse_args()
+    if args.fleet_file:
+        secrets = None
+        if args.secrets_file:
+            with open(args.secrets_file) as f:
+                secrets = json.load(f)
+        fleet = load_fleet(args.fleet_file, secrets)
+        provisioned, failures = provision_fleet(args.ssh_key_file, args.scp_dir, args.master_ip, fleet, args.docker_registry, args.concurrency)
+        close_ssh_clients()
+        print(f"Provisioned {len(provisioned)} agents: {', '.join(provisioned)}")
+        if failures:
+            raise SystemExit(f"Failed to provision {len(failures)} agents: {', '.join(sorted(failures))}")
+        return
+    if not (args.secret_file and args.metadata_file and args.agent_name):
+        parser.error('Give --fleet-file, or all of --secret-file, --metadata-file and --agent-name')
+
     with open(args.metadata_file) as f:
         metadata = json.load(f)
 
@@ -89,14 +142,14 @@ def main():
 
     with open(args.secret_file) as f:
         secret = f.read().strip()
-    network_info = get_network_info(args.master_ip, open(args.ssh_key_file, 'r'))
+    network_info = get_network_info(args.master_ip, args.ssh_key_file)
     master_ip = find_matching_ip(vm_ipv4, network_info)
     if not master_ip:
         print("No matching IP found in the same subnet.")
         return
-    with open(args.ssh_key_file) as ssh_key_file:
-        scp_directory_to_remote(ssh_key_file, args.scp_dir, vm_ipv4)
+    scp_directory_to_remote(args.ssh_key_file, args.scp_dir, vm_ipv4)
     run_remote_command(args.ssh_key_file, vm_ipv4, master_ip, args.agent_name, secret, args.docker_registry)
+    close_ssh_clients()
 
 if __name__ == "__main__":
     main()
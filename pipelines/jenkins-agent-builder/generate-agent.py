@@ -1,10 +1,51 @@
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 import json
-import xml.etree.ElementTree as ET
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def create_agent(jenkins_url, agent_name, username, api_token, label, executors):
+# (connect, read) timeout in seconds for every Jenkins call
+DEFAULT_TIMEOUT = (5, 60)
+# The agent secret is the 64-hex-char first <argument> of the JNLP file
+SECRET_PATTERN = re.compile(r"<argument>([0-9a-f]{64})</argument>")
+
+_crumb_lock = threading.Lock()
+
+def get_jenkins_session(jenkins_url, username, api_token, pool_size=8):
+    # One authenticated keep-alive session for the whole run
+    session = requests.Session()
+    session.auth = HTTPBasicAuth(username, api_token)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.crumb_checked = False
+    return session
+
+def ensure_crumb(session, jenkins_url):
+    # Fetched once per session; the crumb is bound to the session cookie, which the session keeps.
+    # Jenkins without CSRF protection (or API-token auth exempt from it) answers 404 here.
+    with _crumb_lock:
+        if session.crumb_checked:
+            return
+        response = session.get(f"{jenkins_url}/crumbIssuer/api/json", timeout=DEFAULT_TIMEOUT)
+        if response.status_code == 200:
+            crumb = response.json()
+            session.headers[crumb["crumbRequestField"]] = crumb["crumb"]
+        elif response.status_code != 404:
+            response.raise_for_status()
+        session.crumb_checked = True
+
+def agent_exists(session, jenkins_url, agent_name):
+    response = session.get(f"{jenkins_url}/computer/{agent_name}/api/json", params={"tree": "displayName"}, timeout=DEFAULT_TIMEOUT)
+    if response.status_code == 404:
+        return False
+    response.raise_for_status()
+    return True
+
+def create_agent(session, jenkins_url, agent_name, label, executors):
     url = f"{jenkins_url}/computer/doCreateItem?name={agent_name}&type=hudson.slaves.DumbSlave"
 
     json_payload = {
@@ -52,11 +93,12 @@ def create_agent(jenkins_url, agent_name, username, api_token, label, executors)
 
     json_payload = json.dumps(json_payload)
 
-    response = requests.post(
+    ensure_crumb(session, jenkins_url)
+    response = session.post(
         url,
         data={"json": json_payload},
         headers={'Content-Type': 'application/x-www-form-urlencoded'},
-        auth=HTTPBasicAuth(username, api_token)
+        timeout=DEFAULT_TIMEOUT
     )
 
     if response.status_code == 200:
@@ -64,63 +106,90 @@ def create_agent(jenkins_url, agent_name, username, api_token, label, executors)
     else:
         print(f"Failed to create agent {agent_name}: {response.status_code}")
         print(response.text)
+        response.raise_for_status()
+        raise RuntimeError(f"Jenkins did not create agent {agent_name} ({response.status_code})")
 
-def get_agent_secret(jenkins_url, agent_name, username, api_token):
+def get_agent_secret(session, jenkins_url, agent_name):
     url = f"{jenkins_url}/computer/{agent_name}/slave-agent.jnlp"
-    response = requests.get(
-        url,
-        auth=HTTPBasicAuth(username, api_token)
-    )
-    if response.status_code == 200:
-        print("Successfully retrieved the secret")
-        return response.text
-    else:
-        print(f"Failed to retrieve agent secret: {response.status_code}")
+    response = session.get(url, timeout=DEFAULT_TIMEOUT)
+    if response.status_code != 200:
+        print(f"Failed to retrieve agent secret for {agent_name}: {response.status_code}")
         print(response.text)
-        return None
+        response.raise_for_status()
+    match = SECRET_PATTERN.search(response.text)
+    if not match:
+        raise ValueError(f"No secret found in the JNLP file for {agent_name}")
+    return match.group(1)
+
+def register_agent(session, jenkins_url, agent_name, label, executors):
+    # Safe to re-run: an agent that already exists is left alone and only its secret is read
+    if agent_exists(session, jenkins_url, agent_name):
+        print(f"Agent {agent_name} already exists, skipping creation")
+    else:
+        create_agent(session, jenkins_url, agent_name, label, executors)
+    return get_agent_secret(session, jenkins_url, agent_name)
 
-def extract_secret_from_jnlp(jnlp_content):
-    try:
-        root = ET.fromstring(jnlp_content)
-        secret = root.find('.//argument').text
-        return secret
-    except Exception as e:
-        print(f"Failed to extract secret: {e}")
-        return None
+def register_agents(session, jenkins_url, agent_names, label, executors, concurrency):
+    secrets, failures = {}, {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(register_agent, session, jenkins_url, agent_name, label, executors): agent_name for agent_name in agent_names}
+        for future in as_completed(futures):
+            agent_name = futures[future]
+            try:
+                secrets[agent_name] = future.result()
+            except Exception as e:
+                print(f"Failed to register agent {agent_name}: {e}")
+                failures[agent_name] = str(e)
+    return secrets, failures
 
 def save_secret_to_file(secret, secret_file):
     with open(secret_file, 'w') as f:
         f.write(secret)
     print(f"Secret saved to {secret_file}")
 
+def save_secrets_to_file(secrets, secrets_file):
+    # {agent_name: secret} for every agent of a bulk run, written once at the end
+    with open(secrets_file, 'w') as f:
+        json.dump(dict(sorted(secrets.items())), f, indent=4)
+    print(f"{len(secrets)} secrets saved to {secrets_file}")
+
 def main():
     parser = argparse.ArgumentParser(description='Create or update a Jenkins agent.')
     parser.add_argument('--jenkins-url', required=True, help='URL of the Jenkins server.')
-    parser.add_argument('--agent-name', required=True, help='Name of the Jenkins agent.')
+    parser.add_argument('--agent-name', help='Name of the Jenkins agent.')
+    parser.add_argument('--agent-names', help='Comma-separated agent names to register in one run.')
     parser.add_argument('--username', required=True, help='Jenkins username.')
     parser.add_argument('--api-token', required=True, help='Jenkins API token.')
     parser.add_argument('--label', required=True, help='Label for the Jenkins agent.')
     parser.add_argument('--executors', type=int, required=True, help='Number of executors')
-    parser.add_argument('--secret-file', required=True, help='Path to file where the secret will be saved.')
+    parser.add_argument('--secret-file', help='Path to file where the secret will be saved.')
+    parser.add_argument('--secrets-file', help='Path to the JSON file of {agent: secret} written by --agent-names.')
+    parser.add_argument('--concurrency', type=int, default=4, help='Max number of agents to register at once with --agent-names.')
 
     args = parser.parse_args()
 
-    jenkins_url = args.jenkins_url
-    agent_name = args.agent_name
-    username = args.username
-    api_token = args.api_token
+    jenkins_url = args.jenkins_url.rstrip('/')
     label = args.label
     executors = args.executors
-    secret_file = args.secret_file
-
-    create_agent(jenkins_url, agent_name, username, api_token, label, executors)
 
-    jnlp_content = get_agent_secret(jenkins_url, agent_name, username, api_token)
+    if args.agent_names:
+        if not args.secrets_file:
+            parser.error('--agent-names needs --secrets-file')
+        agent_names = list(dict.fromkeys(name.strip() for name in args.agent_names.split(',') if name.strip()))
+        session = get_jenkins_session(jenkins_url, args.username, args.api_token, pool_size=args.concurrency)
+        secrets, failures = register_agents(session, jenkins_url, agent_names, label, executors, args.concurrency)
+        session.close()
+        save_secrets_to_file(secrets, args.secrets_file)
+        if failures:
+            raise SystemExit(f"Failed to register {len(failures)} agents: {', '.join(sorted(failures))}")
+        return
+    if not (args.agent_name and args.secret_file):
+        parser.error('Give --agent-names and --secrets-file, or --agent-name and --secret-file')
 
-    if jnlp_content:
-        secret = extract_secret_from_jnlp(jnlp_content)
-        if secret:
-            save_secret_to_file(secret, secret_file)
+    session = get_jenkins_session(jenkins_url, args.username, args.api_token)
+    secret = register_agent(session, jenkins_url, args.agent_name, label, executors)
+    session.close()
+    save_secret_to_file(secret, args.secret_file)
 
 if __name__ == "__main__":
     main()
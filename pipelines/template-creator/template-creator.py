@@ -1,75 +1,70 @@
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
-import requests
 import json
 import argparse
+import hashlib
+import base64
 import os
-import shutil
+import subprocess
+import requests
 import paramiko
 from scp import SCPClient
 import time
+import re
 from urllib.parse import quote
 import threading
 from queue import Queue
 from queue import Empty
-
-vmid_lock = threading.Lock()
-storage_lock = threading.Lock()
-
-def get_cluster_query_output(cluster_query, proxmox_ip, token_name, token_secret):
-    api_url = f"https://{proxmox_ip}:8006/{cluster_query}"
-    headers = {
-        "Authorization": f"PVEAPIToken={token_name}={token_secret}"
-    }
-    
-    response = requests.get(api_url, headers=headers, verify=False)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        response.raise_for_status()
-
-def delete_cluster_query(cluster_query, proxmox_ip, token_name, token_secret):
-    api_url = f"https://{proxmox_ip}:8006/{cluster_query}"
-    headers = {
-        "Authorization": f"PVEAPIToken={token_name}={token_secret}"
-    }
-
-    response = requests.delete(api_url, headers=headers, verify=False)
-    
-    if response.status_code in (200, 204):
-        return response.json() if response.content else "Deletion successful"
-    else:
-        response.raise_for_status()
-
-def post_cluster_query(cluster_query, data, proxmox_ip, token_name, token_secret):
-    api_url = f"https://{proxmox_ip}:8006/{cluster_query}"
-    headers = {
-        "Authorization": f"PVEAPIToken={token_name}={token_secret}"
-    }
-
-    if data:
-        response = requests.post(api_url, headers=headers, data=data, verify=False)
-    else:
-        response = requests.post(api_url, headers=headers, verify=False)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        response.raise_for_status()
-
-def put_cluster_query(cluster_query, data, proxmox_ip, token_name, token_secret):
-    api_url = f"https://{proxmox_ip}:8006/{cluster_query}"
-    headers = {
-        "Authorization": f"PVEAPIToken={token_name}={token_secret}"
-    }
-
-    response = requests.put(api_url, headers=headers, data=data, verify=False)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        response.raise_for_status()
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from proxmox_api import get_cluster_query_output, post_cluster_query, put_cluster_query
+from proxmox_tasks import wait_for_task, wait_for_vm_status
+from cluster_resources import get_cluster_snapshot, invalidate_cluster_snapshot, lookup_by_name
+from vmid_allocator import allocate_vmid
+from image_cache import DEFAULT_MAX_BYTES, fetch_image
+from downloads import DEFAULT_CONNECTIONS, default_checksums_url, expected_sha256, get_download_session, probe, sha256_file
+from transfer_scheduler import DEFAULT_LIMITS, TransferScheduler
+from placement import NodePlacer, get_node_addresses
+from readiness import READY_DEADLINE, guest_agent_ping, retry_until_ready, wait_for_guest
+from timing import print_summary, span, write_prometheus, write_report
+from ssh_pool import channel_slot, close_ssh_client, close_ssh_clients, get_ssh_client, load_private_key, run_command
+
+# Storage that qm importdisk writes template disks to
+IMPORT_STORAGE = "local-lvm"
+# What one template build holds on its node, matching create_vm and the 20G resize
+BUILD_CORES = 2
+BUILD_MEMORY = 2048 * 1024 ** 2
+BUILD_DISK = 20 * 1024 ** 3
+# Hardware every template VM is created with, and the size its disk is grown to
+TEMPLATE_HARDWARE = {
+    "cores": "2",
+    "memory": "2048",
+    "net0": "virtio,bridge=vmbr0",
+    "onboot": "1",
+    "vga": "qxl",
+    "hotplug": "disk,network,usb",
+}
+TEMPLATE_DISK_SIZE = "20G"
+# Storage (and its directory on every node) that holds cloud-init snippets; it needs the
+# "snippets" content type enabled
+SNIPPET_STORAGE = "local"
+SNIPPET_DIR = "/var/lib/vz/snippets"
+# Bump when a build step changes in a way the fingerprint inputs below don't capture
+# (configure_disk, fix_networking, the cloud-init defaults), so every template is rebuilt once
+FINGERPRINT_VERSION = 1
+FINGERPRINT_PATTERN = re.compile(r"^fingerprint: ([0-9a-f]{64})$", re.MULTILINE)
+
+# Seconds each template's temporary VM took from start to reachable over SSH
+time_to_ready = {}
+# Templates skipped because a template with the same fingerprint already exists, name -> vmid
+skipped_templates = {}
+# Templates whose build raised, name -> error
+failed_templates = {}
+
+# Streaming mode buffers at most STREAM_QUEUE_CHUNKS * STREAM_CHUNK_SIZE bytes per image
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_QUEUE_CHUNKS = 16
 
 def generate_public_key(private_key_path, public_key_path):
     try:
@@ -110,82 +105,164 @@ def generate_public_key(private_key_path, public_key_path):
         print(f"Error loading private key: {e}")
         raise
 
-def get_vm_metadata(proxmox_ip, token_name, token_secret):
-    vm_data = {}
-    vmids = get_cluster_query_output("api2/json/cluster/resources", proxmox_ip, token_name, token_secret)["data"]
-    for vm in vmids:
-        if vm["type"] == "qemu":
-            vm_data[vm["vmid"]] = {}
-            vm_data[vm["vmid"]]["proxmox_node"] = vm["node"]
-            vm_data[vm["vmid"]]["status"] = vm["status"]
-    return vm_data
-
-def pick_vmid(proxmox_ip, token_name, token_secret, vmid_start, vmid_end):
-    time.sleep(5) # time for proxmox to do stuff
-    vm_metadata = get_vm_metadata(proxmox_ip, token_name, token_secret)
-    used_vmids = vm_metadata.keys()
-    for vmid in range(vmid_start, vmid_end + 1):
-        if vmid not in used_vmids:
-            return vmid
-    raise ValueError("No available VMID found in the specified range")
-
-def get_qcow(image_url, qcow_dir, qcow_file, name):
-    os.makedirs(qcow_dir, exist_ok=True)
-    qcow_path = f"/tmp/{name}.img"
-
-    response = requests.get(image_url, stream=True)
-    response.raise_for_status()
-
-    with open(qcow_path, 'wb') as file:
-        for chunk in response.iter_content(chunk_size=8192):
-            file.write(chunk)
-
-    shutil.move(qcow_path, qcow_file)
+def get_qcow(image_url, qcow_dir, qcow_file, name, image_cache_dir, image_cache_max_bytes=DEFAULT_MAX_BYTES, connections=DEFAULT_CONNECTIONS, compression="none"):
+    # Returns the file to upload. The disk is grown after import (resize_disk), so nothing touches
+    # the image here and the cached blob can be uploaded as is.
+    cached_file = fetch_image(image_url, image_cache_dir, image_cache_max_bytes, connections=connections)
+    if compression != "qcow2":
+        return cached_file
 
-    print(f"Moving {qcow_path} to {qcow_dir}")
-    os.system(f"qemu-img resize {qcow_file} 20G")
-
-def create_ssh_client(server, port, user, password=None, key_file=None):
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.WarningPolicy())
-    
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    
-    if key_file:
-        client.connect(server, port, username=user, key_filename=key_file, allow_agent=False, look_for_keys=False)
-    else:
-        client.connect(server, port, username=user, password=password, allow_agent=False, look_for_keys=False)
-    
-    return client
+    # Rewrites only allocated clusters, compressed; raw images shrink the most
+    os.makedirs(qcow_dir, exist_ok=True)
+    subprocess.run(["qemu-img", "convert", "-c", "-O", "qcow2", cached_file, qcow_file], check=True)
+    print(f"Compressed {name} image from {os.path.getsize(cached_file)} to {os.path.getsize(qcow_file)} bytes")
+    return qcow_file
 
-def upload_qcow(proxmox_ip, proxmox_node, user, password, qcow_file, remote_dir, vmid, name):
+def upload_qcow(proxmox_ip, proxmox_node, user, password, qcow_file, remote_dir, vmid, name, scheduler, compression="none"):
     remote_filename = f"{remote_dir}/{name}.qcow2"
-    ssh = create_ssh_client(proxmox_ip, 22, user, password)
-    scp = SCPClient(ssh.get_transport())
+    # Pooled: every template built on this node shares one SSH connection
+    ssh = get_ssh_client(proxmox_ip, user, password=password)
     
-    stdin, stdout, stderr = ssh.exec_command(f'mkdir -p {remote_dir}')
-    exit_status = stdout.channel.recv_exit_status()
-    if exit_status != 0:
-        print(f"Failed to create directory {remote_dir} on {proxmox_ip}")
-        return
+    if not run_remote_command(ssh, f"mkdir -p {remote_dir}"):
+        raise RuntimeError(f"Failed to create directory {remote_dir} on {proxmox_ip}")
     
-    scp.put(qcow_file, remote_path=remote_filename)
+    with scheduler.slot("upload", proxmox_node, name), channel_slot(ssh), span("upload", name, proxmox_node):
+        if compression == "zstd":
+            upload_zstd(ssh, qcow_file, remote_filename, proxmox_node, scheduler)
+        else:
+            scp = SCPClient(ssh.get_transport(), progress=scheduler.scp_progress(proxmox_node))
+            try:
+                scp.put(qcow_file, remote_path=remote_filename)
+            finally:
+                scp.close()
     
-    stdin, stdout, stderr = ssh.exec_command(f"qm importdisk {vmid} {remote_filename} local-lvm")
-    exit_status = stdout.channel.recv_exit_status()
+    with scheduler.slot("import", f"{proxmox_node}/{IMPORT_STORAGE}", name), span("import", name, proxmox_node):
+        if not run_remote_command(ssh, f"qm importdisk {vmid} {remote_filename} {IMPORT_STORAGE}"):
+            raise RuntimeError(f"Failed to import disk {remote_filename} to VM {vmid} on {proxmox_ip}")
+
+def upload_zstd(ssh, local_file, remote_filename, proxmox_node, scheduler):
+    # zstd on both ends: compressed on the way out, decompressed on the node with sparse writes,
+    # so zero runs in the image take neither bandwidth nor disk. Caller holds the channel slot.
+    partial_filename = f"{remote_filename}.part"
+    channel = ssh.get_transport().open_session()
+    compressor = None
+    try:
+        channel.exec_command(f"zstd -d -q -f --sparse -o {partial_filename} && mv {partial_filename} {remote_filename}")
+        compressor = subprocess.Popen(["zstd", "-c", "-q", "-T0", local_file], stdout=subprocess.PIPE)
+        sent = 0
+        for chunk in iter(lambda: compressor.stdout.read(STREAM_CHUNK_SIZE), b""):
+            channel.sendall(chunk)
+            sent += len(chunk)
+            scheduler.throttle(proxmox_node, len(chunk))
+        channel.shutdown_write()
+        if compressor.wait() != 0:
+            raise RuntimeError(f"zstd failed to compress {local_file}")
+        exit_status = channel.recv_exit_status()
+        if exit_status != 0:
+            errors = channel.makefile_stderr("r").read().strip()
+            raise RuntimeError(f"Failed to decompress into {remote_filename} ({exit_status}): {errors}")
+    finally:
+        if compressor is not None and compressor.poll() is None:
+            compressor.kill()
+        channel.close()
+    print(f"Sent {sent} compressed bytes for {os.path.getsize(local_file)} bytes of {local_file}")
+
+def run_remote_command(ssh, command):
+    exit_status, output, errors = run_command(ssh, command)
     if exit_status != 0:
-        print(f"Failed to import disk {remote_filename} to VM {vmid} on {proxmox_ip}")
-        return
-    
-    scp.close()
-    ssh.close()
+        print(f"Remote command '{command}' failed ({exit_status}): {errors.strip()}")
+    return exit_status == 0
+
+def stream_qcow(proxmox_ip, proxmox_node, user, password, image_url, remote_dir, name, scheduler):
+    # Download and upload overlap: one thread reads HTTP chunks into a bounded queue while this
+    # thread writes them to the node over SFTP, so the agent never holds more than a few MB
+    remote_filename = f"{remote_dir}/{name}.qcow2"
+    partial_filename = f"{remote_filename}.part"
+    chunks = Queue(maxsize=STREAM_QUEUE_CHUNKS)
+    stop = threading.Event()
+    errors = []
+
+    def download():
+        try:
+            with get_download_session().get(image_url, stream=True, timeout=(10, 120)) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    if stop.is_set():
+                        break
+                    chunks.put(chunk)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            chunks.put(None)
+
+    ssh = get_ssh_client(proxmox_ip, user, password=password)
+    if not run_remote_command(ssh, f"mkdir -p {remote_dir}"):
+        raise RuntimeError(f"Failed to create directory {remote_dir} on {proxmox_ip}")
+
+    try:
+        with scheduler.slot("upload", proxmox_node, name), channel_slot(ssh), span("stream", name, proxmox_node):
+            downloader = threading.Thread(target=download, daemon=True)
+            downloader.start()
+            digest = hashlib.sha256()
+            size = 0
+            # Set once the downloader's None sentinel has been taken off the queue
+            drained = False
+            sftp = ssh.open_sftp()
+            try:
+                with sftp.open(partial_filename, "wb") as remote_file:
+                    remote_file.set_pipelined(True)
+                    while (chunk := chunks.get()) is not None:
+                        remote_file.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                        scheduler.throttle(proxmox_node, len(chunk))
+                    drained = True
+            except Exception:
+                # Pipelined write errors surface on close, after the sentinel was consumed
+                stop.set()
+                while not drained:
+                    drained = chunks.get() is None
+                raise
+            finally:
+                sftp.close()
+            downloader.join()
+
+        if errors:
+            raise errors[0]
+        wanted = expected_sha256(image_url, default_checksums_url(image_url))
+        if wanted and wanted != digest.hexdigest():
+            raise ValueError(f"Checksum mismatch for {image_url}: expected {wanted}, got {digest.hexdigest()}")
+        if not run_remote_command(ssh, f"mv {partial_filename} {remote_filename}"):
+            raise RuntimeError(f"Failed to move {partial_filename} into place on {proxmox_ip}")
+    except Exception:
+        # Never leave a partial image behind on the node, whichever side of the stream failed
+        run_remote_command(ssh, f"rm -f {partial_filename}")
+        raise
+    print(f"Streamed {size} bytes from {image_url} to {proxmox_ip}:{remote_filename}")
+    return remote_filename
+
+def import_remote_qcow(proxmox_ip, proxmox_node, user, password, remote_filename, vmid, name, scheduler):
+    # Import runs on the node against the streamed file
+    ssh = get_ssh_client(proxmox_ip, user, password=password)
+    with scheduler.slot("import", f"{proxmox_node}/{IMPORT_STORAGE}", name), span("import", name, proxmox_node):
+        if not run_remote_command(ssh, f"qm importdisk {vmid} {remote_filename} {IMPORT_STORAGE}"):
+            raise RuntimeError(f"Failed to import disk {remote_filename} to VM {vmid} on {proxmox_ip}")
 
 def configure_disk(proxmox_ip, proxmox_node, token_name, token_secret, vmid):
     endpoint=f"api2/json/nodes/{proxmox_node}/qemu/{vmid}/config"
     data=f"scsihw=virtio-scsi-pci&virtio0=local-lvm:vm-{vmid}-disk-0&serial0=socket&boot=c&bootdisk=virtio0"
     put_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret)
 
+def resize_disk(proxmox_ip, proxmox_node, token_name, token_secret, vmid):
+    # Grown after import: the image travels and imports at its real size, and the new space
+    # is thin on local-lvm either way
+    endpoint = f"api2/json/nodes/{proxmox_node}/qemu/{vmid}/resize"
+    data={}
+    data["disk"]="virtio0"
+    data["size"]=TEMPLATE_DISK_SIZE
+    response = put_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret)
+    wait_for_task(proxmox_ip, token_name, token_secret, response)
+
 def configure_cloud_init(proxmox_ip, proxmox_node, token_name, token_secret, vmid, user, password, public_key_path):
     endpoint = f"api2/json/nodes/{proxmox_node}/qemu/{vmid}/config"
 
@@ -202,7 +279,7 @@ def configure_cloud_init(proxmox_ip, proxmox_node, token_name, token_secret, vmi
     data["ciupgrade"]="0"
     put_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret)
 
-def configure_custom(proxmox_ip, proxmox_node, token_name, token_secret, vmid, user, ssh_key_file, ip_to_use):
+def configure_custom(proxmox_ip, proxmox_node, token_name, token_secret, vmid, user, ssh_key_file, ip_to_use, ready_timeout=READY_DEADLINE, agent_ping=False):
     ip_address = ip_to_use.split('/')[0]
     print(f"Setting IP to {ip_address} temporarily")
     data={}
@@ -210,27 +287,79 @@ def configure_custom(proxmox_ip, proxmox_node, token_name, token_secret, vmid, u
     endpoint = f"api2/json/nodes/{proxmox_node}/qemu/{vmid}/config"
     put_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret)
     start_endpoint=f"/api2/json/nodes/{proxmox_node}/qemu/{vmid}/status/start"
-    post_cluster_query(cluster_query=start_endpoint, data=None, proxmox_ip=proxmox_ip, token_name=token_name, token_secret=token_secret)
-    time.sleep(180) # box needs time to spin up
-    ssh = create_ssh_client(ip_address, 22, user, key_file=ssh_key_file)
-    scp = SCPClient(ssh.get_transport())
+    response = post_cluster_query(cluster_query=start_endpoint, data=None, proxmox_ip=proxmox_ip, token_name=token_name, token_secret=token_secret)
+    wait_for_task(proxmox_ip, token_name, token_secret, response)
+    started_at = time.time()
+    ping = (lambda: guest_agent_ping(proxmox_ip, proxmox_node, token_name, token_secret, vmid)) if agent_ping else None
+    wait_for_guest(ip_address, 22, ready_timeout, ping)
+    # sshd can be up before cloud-init has put the user's key in place
+    remaining = max(ready_timeout - (time.time() - started_at), 0)
+    ssh = retry_until_ready(lambda: get_ssh_client(ip_address, user, key_file=ssh_key_file), remaining, (paramiko.SSHException, OSError))
+    ready_after = time.time() - started_at
+    print(f"VM {vmid} accepted SSH {ready_after:.1f}s after starting")
 
     remote_dir="/bootstrap"
     remote_temp_filename=f"/home/{user}/init-image.sh"
     remote_filename=f"{remote_dir}/init-image.sh"
-    stdin, stdout, stderr = ssh.exec_command(f'sudo mkdir -p {remote_dir}')
-    exit_status = stdout.channel.recv_exit_status()
-    if exit_status != 0:
-        print(f"Failed to create directory {remote_dir} on {ip_to_use}")
-        return
-    scp.put("init-image.sh", remote_path=remote_temp_filename)
-    stdin, stdout, stderr = ssh.exec_command(f'sudo mv {remote_temp_filename} {remote_filename} && sudo chmod +x {remote_filename} && sudo {remote_filename}')
-    exit_status = stdout.channel.recv_exit_status()
-    if exit_status != 0:
-        print(f"Failed to execute {remote_filename} on {ip_to_use}")
-        return
-    stdin, stdout, stderr = ssh.exec_command(f'sudo shutdown now')
-    time.sleep(60)
+    try:
+        if not run_remote_command(ssh, f'sudo mkdir -p {remote_dir}'):
+            print(f"Failed to create directory {remote_dir} on {ip_to_use}")
+            return ready_after
+        with channel_slot(ssh):
+            scp = SCPClient(ssh.get_transport())
+            scp.put("init-image.sh", remote_path=remote_temp_filename)
+            scp.close()
+        if not run_remote_command(ssh, f'sudo mv {remote_temp_filename} {remote_filename} && sudo chmod +x {remote_filename} && sudo {remote_filename}'):
+            print(f"Failed to execute {remote_filename} on {ip_to_use}")
+            return ready_after
+        with channel_slot(ssh):
+            ssh.exec_command(f'sudo shutdown now')
+    finally:
+        # The temporary IP goes to the next template's VM, so this connection must not be reused
+        close_ssh_client(ip_address, user)
+    wait_for_vm_status(proxmox_ip, proxmox_node, token_name, token_secret, vmid, "stopped")
+    return ready_after
+
+def vendor_snippet(init_script="init-image.sh"):
+    # cloud-config that drops init-image.sh into /bootstrap and runs it on first boot. JSON is
+    # valid YAML, so no YAML library is needed. The name carries the script hash: clones made from
+    # older templates keep pointing at the snippet they were built with.
+    with open(init_script, "rb") as f:
+        script = f.read()
+    config = {
+        "write_files": [{
+            "path": "/bootstrap/init-image.sh",
+            "permissions": "0755",
+            "encoding": "b64",
+            "content": base64.b64encode(script).decode(),
+        }],
+        # init-image.sh only enables the agent; in the boot cycle the template's next start ran it
+        "runcmd": [["/bootstrap/init-image.sh"], "systemctl start qemu-guest-agent || true"],
+    }
+    filename = f"template-init-{hashlib.sha256(script).hexdigest()[:12]}.yaml"
+    return filename, "#cloud-config\n" + json.dumps(config, indent=2) + "\n"
+
+def upload_vendor_snippet(node_address, user, password, filename, content):
+    remote_filename = f"{SNIPPET_DIR}/{filename}"
+    ssh = get_ssh_client(node_address, user, password=password)
+    if not run_remote_command(ssh, f"mkdir -p {SNIPPET_DIR}"):
+        raise RuntimeError(f"Failed to create directory {SNIPPET_DIR} on {node_address}")
+    with channel_slot(ssh):
+        sftp = ssh.open_sftp()
+        try:
+            with sftp.open(f"{remote_filename}.part", "w") as remote_file:
+                remote_file.write(content)
+            sftp.posix_rename(f"{remote_filename}.part", remote_filename)
+        finally:
+            sftp.close()
+    print(f"Vendor snippet {filename} written to {node_address}:{SNIPPET_DIR}")
+
+def configure_vendor_snippet(proxmox_ip, proxmox_node, token_name, token_secret, vmid, filename):
+    # Proxmox still generates the user data (ciuser, sshkeys, ipconfig); only vendor data is ours
+    endpoint = f"api2/json/nodes/{proxmox_node}/qemu/{vmid}/config"
+    data={}
+    data["cicustom"]=f"vendor={SNIPPET_STORAGE}:snippets/{filename}"
+    put_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret)
 
 def fix_networking(proxmox_ip, proxmox_node, token_name, token_secret, vmid):
     # After the image has been messed with a bit, we need to fix it
@@ -246,21 +375,73 @@ def make_template(proxmox_ip, proxmox_node, token_name, token_secret, vmid):
 
     if response:
         print(f"Template creation response: {response}")
+        wait_for_task(proxmox_ip, token_name, token_secret, response)
+        invalidate_cluster_snapshot(proxmox_ip)
     else:
         print("Failed to create template")
 
 def create_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid, name):
     endpoint=f"api2/json/nodes/{proxmox_node}/qemu"
-    data={}
+    data=dict(TEMPLATE_HARDWARE)
     data["vmid"]=vmid
     data["name"]=name
-    data["cores"]="2"
-    data["memory"]="2048"
-    data["net0"]="virtio,bridge=vmbr0"
-    data["onboot"]="1"
-    data["vga"]="qxl"
-    data["hotplug"]="disk,network,usb"
-    post_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret)
+    response = post_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret)
+    # A lost VMID race can also fail the qmcreate task itself; allocate_vmid retries it from here
+    wait_for_task(proxmox_ip, token_name, token_secret, response)
+
+def upstream_image_id(image_url):
+    # Identifies the upstream image without downloading it: the published SHA256 when the distro
+    # has one, else the validators of a HEAD. None means there is nothing stable to compare.
+    digest = expected_sha256(image_url, default_checksums_url(image_url))
+    if digest:
+        return f"sha256:{digest}"
+    try:
+        info = probe(image_url)
+    except requests.exceptions.RequestException as e:
+        print(f"Could not probe {image_url}: {e}")
+        return None
+    if info["etag"] or info["last_modified"]:
+        return f"etag:{info['etag']};last-modified:{info['last_modified']};size:{info['size']}"
+    return None
+
+def template_fingerprint(template, ssh_keys, template_ssh_key, provision_mode="boot"):
+    # Everything that ends up in the template: the image, init-image.sh, the cloud-init user,
+    # password and keys, and the VM hardware. Returns (fingerprint, image id), or (None, None)
+    # when the upstream image can't be identified and the template must always be rebuilt.
+    image_id = upstream_image_id(template['img_url'])
+    if image_id is None:
+        return None, None
+    inputs = {
+        "version": FINGERPRINT_VERSION,
+        "image": image_id,
+        "template": template,
+        "init_image": sha256_file("init-image.sh"),
+        "ssh_keys": sorted(ssh_keys),
+        "template_ssh_key": load_private_key(template_ssh_key).get_base64(),
+        "hardware": TEMPLATE_HARDWARE,
+        "disk_size": TEMPLATE_DISK_SIZE,
+        "import_storage": IMPORT_STORAGE,
+    }
+    if provision_mode != "boot":
+        inputs["provision_mode"] = provision_mode
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest(), image_id
+
+def find_matching_template(proxmox_ip, token_name, token_secret, name, fingerprint):
+    # The fingerprint lives in the template's description, so it travels with the template
+    snapshot = get_cluster_snapshot(proxmox_ip, token_name, token_secret)
+    for vm in lookup_by_name(snapshot, name, template=True):
+        endpoint = f"api2/json/nodes/{vm['node']}/qemu/{vm['vmid']}/config"
+        config = get_cluster_query_output(endpoint, proxmox_ip, token_name, token_secret)["data"]
+        match = FINGERPRINT_PATTERN.search(config.get("description", ""))
+        if match and match.group(1) == fingerprint:
+            return vm
+    return None
+
+def record_fingerprint(proxmox_ip, proxmox_node, token_name, token_secret, vmid, fingerprint, image_id):
+    endpoint = f"api2/json/nodes/{proxmox_node}/qemu/{vmid}/config"
+    data={}
+    data["description"]=f"Built by template-creator on {time.strftime('%Y-%m-%d %H:%M:%S')}\nfingerprint: {fingerprint}\nimage: {image_id}\n"
+    put_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret)
 
 def check_pool(proxmox_ip, token_name, token_secret, pool_name):
     # check if pool exists already
@@ -299,9 +480,10 @@ def set_vm_resource_pool(proxmox_ip, token_name, token_secret, resource_pool, vm
     data["poolid"]=resource_pool
     data["vms"]=vmid
     data["allow-move"]="1"
-    put_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret) 
+    put_cluster_query(endpoint, data, proxmox_ip, token_name, token_secret)
+    invalidate_cluster_snapshot(proxmox_ip)
 
-def vm_creation_pipeline(proxmox_ip, proxmox_node, token_name, token_secret, resource_pool, vmid, name, image_url, ssh_keys, qcow_dir, user, password, proxmox_user, proxmox_password, ip_to_use, template_ssh_key):
+def vm_creation_pipeline(proxmox_ip, proxmox_node, node_address, token_name, token_secret, resource_pool, vmid, name, image_url, ssh_keys, qcow_dir, user, password, proxmox_user, proxmox_password, ip_to_use, template_ssh_key, image_options, fingerprint=None, image_id=None):
     remote_dir="/root/qcows"
     qcow_file = f"{qcow_dir}/{name}.qcow2"
 
@@ -309,90 +491,151 @@ def vm_creation_pipeline(proxmox_ip, proxmox_node, token_name, token_secret, res
     public_key = generate_public_key(template_ssh_key, ssh_keys)
     print(f"Generated public key: {public_key}")
 
-    print(f"Getting cloud image from {image_url} and placing in {qcow_file}")
-    get_qcow(image_url, qcow_dir, qcow_file, name)
-
-    print(f"Uploading {qcow_file} to proxmox")
-    print("Uploading the qcow, this could take a while")
-    with storage_lock:
-        upload_qcow(proxmox_ip, proxmox_node, proxmox_user, proxmox_password, qcow_file, remote_dir, vmid, name)
-    time.sleep(5)
-    os.remove(qcow_file)
+    if image_options["transfer_mode"] == "stream":
+        print(f"Streaming {image_url} straight to {node_address}:{remote_dir}")
+        remote_filename = stream_qcow(node_address, proxmox_node, proxmox_user, proxmox_password, image_url, remote_dir, name, image_options["scheduler"])
+        import_remote_qcow(node_address, proxmox_node, proxmox_user, proxmox_password, remote_filename, vmid, name, image_options["scheduler"])
+    else:
+        print(f"Getting cloud image from {image_url} and placing in {qcow_file}")
+        with span("download", name):
+            upload_file = get_qcow(image_url, qcow_dir, qcow_file, name, image_options["cache_dir"], image_options["cache_max_bytes"], image_options["download_connections"], image_options["compression"])
+
+        print(f"Uploading {upload_file} to proxmox")
+        print("Uploading the qcow, this could take a while")
+        upload_qcow(node_address, proxmox_node, proxmox_user, proxmox_password, upload_file, remote_dir, vmid, name, image_options["scheduler"], image_options["compression"])
+        # Only the compressed copy is ours to remove; the cached blob stays for the next run
+        if upload_file == qcow_file:
+            os.remove(qcow_file)
     print("Configuring disk on template")
-    configure_disk(proxmox_ip, proxmox_node, token_name, token_secret, vmid)
+    with span("configure", name, proxmox_node):
+        configure_disk(proxmox_ip, proxmox_node, token_name, token_secret, vmid)
+    with span("resize", name, proxmox_node):
+        resize_disk(proxmox_ip, proxmox_node, token_name, token_secret, vmid)
 
     print("Configuring cloud-init")
-    configure_cloud_init(proxmox_ip, proxmox_node, token_name, token_secret, vmid, user, password, ssh_keys)
-    time.sleep(5)
+    with span("cloud-init", name, proxmox_node):
+        configure_cloud_init(proxmox_ip, proxmox_node, token_name, token_secret, vmid, user, password, ssh_keys)
 
-    print("Installing base configuration")
-    configure_custom(proxmox_ip, proxmox_node, token_name, token_secret, vmid, user, template_ssh_key, ip_to_use)
+    if image_options["provision_mode"] == "snippet":
+        # No boot on the build path: each clone runs init-image.sh from cloud-init on its first boot
+        print(f"Attaching vendor snippet {image_options['snippet']}")
+        configure_vendor_snippet(proxmox_ip, proxmox_node, token_name, token_secret, vmid, image_options["snippet"])
+    else:
+        print("Installing base configuration")
+        with span("boot", name, proxmox_node):
+            time_to_ready[name] = configure_custom(proxmox_ip, proxmox_node, token_name, token_secret, vmid, user, template_ssh_key, ip_to_use, image_options["ready_timeout"], image_options["ready_agent_ping"])
     fix_networking(proxmox_ip, proxmox_node, token_name, token_secret, vmid)
 
     print("Converting to template")
-    make_template(proxmox_ip, proxmox_node, token_name, token_secret, vmid)
-    set_vm_resource_pool(proxmox_ip, token_name, token_secret, resource_pool, vmid)
-
-def runner(proxmox_ip, proxmox_node, token_name, token_secret, resource_pool, name, vmid_start, vmid_end, qcow_dir, ssh_keys, image_location, user, password, proxmox_user, proxmox_password, ip_to_use, template_ssh_key, temporary_ips_queue):
-    with vmid_lock:
-        vmid = pick_vmid(proxmox_ip, token_name, token_secret, vmid_start, vmid_end)
-        print(f"Creating VM {name} with VMID: {vmid}")
-        create_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid, name)
-    print(f"Here is the vmid to use for {name}: {vmid}")
-    vm_creation_pipeline(proxmox_ip, proxmox_node, token_name, token_secret, resource_pool, vmid, name, image_location, ssh_keys, qcow_dir, user, password, proxmox_user, proxmox_password, ip_to_use, template_ssh_key)
-
-def thread_worker(queue, proxmox_ip, proxmox_node, token_name, token_secret, resource_pool, template_start_id, template_end_id, qcow_dir, ssh_keys, proxmox_user, proxmox_password, temporary_ips_queue, template_ssh_key):
+    with span("template", name, proxmox_node):
+        make_template(proxmox_ip, proxmox_node, token_name, token_secret, vmid)
+        set_vm_resource_pool(proxmox_ip, token_name, token_secret, resource_pool, vmid)
+        # Recorded last, so a build that failed part way is never mistaken for a current template
+        if fingerprint:
+            record_fingerprint(proxmox_ip, proxmox_node, token_name, token_secret, vmid, fingerprint, image_id)
+
+def runner(proxmox_ip, placer, node_addresses, token_name, token_secret, resource_pool, name, vmid_start, vmid_end, qcow_dir, ssh_keys, image_location, user, password, proxmox_user, proxmox_password, ip_to_use, template_ssh_key, temporary_ips_queue, image_options, fingerprint=None, image_id=None):
+    proxmox_node = placer.choose(name, BUILD_CORES, BUILD_MEMORY, BUILD_DISK)
+    # A single-node cluster may not list addresses; the API host is then the node
+    node_address = node_addresses.get(proxmox_node, proxmox_ip)
+    try:
+        print(f"Creating VM {name} on {proxmox_node} with a VMID between {vmid_start} and {vmid_end}")
+        with span("vmid", name, proxmox_node):
+            vmid, _ = allocate_vmid(
+                proxmox_ip, token_name, token_secret, vmid_start, vmid_end,
+                lambda vmid: create_vm(proxmox_ip, proxmox_node, token_name, token_secret, vmid, name)
+            )
+        print(f"Here is the vmid to use for {name}: {vmid}")
+        vm_creation_pipeline(proxmox_ip, proxmox_node, node_address, token_name, token_secret, resource_pool, vmid, name, image_location, ssh_keys, qcow_dir, user, password, proxmox_user, proxmox_password, ip_to_use, template_ssh_key, image_options, fingerprint, image_id)
+    finally:
+        placer.release(proxmox_node, BUILD_CORES, BUILD_MEMORY, BUILD_DISK)
+
+def thread_worker(queue, proxmox_ip, placer, node_addresses, token_name, token_secret, resource_pool, template_start_id, template_end_id, qcow_dir, ssh_keys, proxmox_user, proxmox_password, temporary_ips_queue, template_ssh_key, image_options):
     while True:
         try:
             template_name, template = queue.get(block=False)
         except Empty:
             break
-        
-        ssh_keys_file = f"{template_name}-keys.pub"
-        with open(ssh_keys_file, 'w') as file:
-            file.write("\n".join(ssh_keys))
-        
-        temporary_ip = temporary_ips_queue.get()
-        
-        runner(
-            proxmox_ip,
-            proxmox_node,
-            token_name,
-            token_secret,
-            resource_pool,
-            template_name,
-            template_start_id,
-            template_end_id,
-            qcow_dir,
-            ssh_keys_file,
-            template['img_url'],
-            template['user'],
-            template['password'],
-            proxmox_user,
-            proxmox_password,
-            temporary_ip,
-            template_ssh_key,
-            temporary_ips_queue
-        )
-        
-        queue.task_done()
-        temporary_ips_queue.put(temporary_ip)
+
+        # A failed template must not take the thread down with it: main() joins the queue and
+        # would wait forever for a task_done() that never comes
+        temporary_ip = None
+        try:
+            fingerprint, image_id = template_fingerprint(template, ssh_keys, template_ssh_key, image_options["provision_mode"])
+            if fingerprint and not image_options["rebuild"]:
+                existing = find_matching_template(proxmox_ip, token_name, token_secret, template_name, fingerprint)
+                if existing:
+                    print(f"Template {template_name} ({existing['vmid']} on {existing['node']}) is current, skipping")
+                    skipped_templates[template_name] = existing['vmid']
+                    continue
+            print(f"Building {template_name}, fingerprint {fingerprint or 'unavailable'}")
+
+            ssh_keys_file = f"{template_name}-keys.pub"
+            with open(ssh_keys_file, 'w') as file:
+                file.write("\n".join(ssh_keys))
+
+            # Only the boot cycle needs one of the scarce temporary IPs
+            temporary_ip = temporary_ips_queue.get() if image_options["provision_mode"] == "boot" else None
+
+            runner(
+                proxmox_ip,
+                placer,
+                node_addresses,
+                token_name,
+                token_secret,
+                resource_pool,
+                template_name,
+                template_start_id,
+                template_end_id,
+                qcow_dir,
+                ssh_keys_file,
+                template['img_url'],
+                template['user'],
+                template['password'],
+                proxmox_user,
+                proxmox_password,
+                temporary_ip,
+                template_ssh_key,
+                temporary_ips_queue,
+                image_options,
+                fingerprint,
+                image_id
+            )
+        except Exception as e:
+            print(f"Building template {template_name} failed: {type(e).__name__}: {e}")
+            failed_templates[template_name] = f"{type(e).__name__}: {e}"
+        finally:
+            queue.task_done()
+            if temporary_ip is not None:
+                temporary_ips_queue.put(temporary_ip)
 
 def main():
     parser = argparse.ArgumentParser(description="Create Proxmox templates")
     parser.add_argument("--proxmox_ip", required=True, help="Proxmox IP address")
-    parser.add_argument("--proxmox_node", required=True, help="Proxmox host to build the template on")
+    parser.add_argument("--proxmox_node", help="Proxmox host to build the templates on; shorthand for a one node --nodes")
+    parser.add_argument("--nodes", help="Comma separated allowlist of nodes to spread template builds over; all online nodes if neither is given")
     parser.add_argument("--token_name", required=True, help="Proxmox API token name")
     parser.add_argument("--token_secret", required=True, help="Proxmox API token secret")
     parser.add_argument("--user", required=True, help="Proxmox SSH user")
     parser.add_argument("--password", required=True, help="Proxmox SSH password")
     parser.add_argument("--template_ssh_key", required=True, help="Path to the private SSH key")
     parser.add_argument("--concurrency", type=int, default=5, help="Number of concurrent threads")
+    parser.add_argument("--download_connections", type=int, default=DEFAULT_CONNECTIONS, help="Parallel range requests per image download")
+    parser.add_argument("--uploads_per_node", type=int, default=DEFAULT_LIMITS["upload"], help="Max number of image uploads to one node at once")
+    parser.add_argument("--imports_per_storage", type=int, default=DEFAULT_LIMITS["import"], help="Max number of qm importdisk runs against one node's storage at once")
+    parser.add_argument("--bandwidth_limit", type=float, default=0, help="Upload bandwidth cap per node in MB/s, 0 for none")
+    parser.add_argument("--ready_timeout", type=int, default=READY_DEADLINE, help="Seconds a temporary VM gets to become reachable over SSH")
+    parser.add_argument("--ready_agent_ping", action="store_true", help="Also wait for the QEMU guest agent to answer before connecting")
+    parser.add_argument("--compression", choices=["none", "qcow2", "zstd"], default="none", help="Cache mode upload: qcow2 recompresses with qemu-img convert -c; zstd compresses the upload stream and writes it sparse on the node")
+    parser.add_argument("--provision_mode", choices=["boot", "snippet"], default="boot", help="boot: run init-image.sh in a temporary VM before templating; snippet: hand it to cloud-init as vendor data, run on each clone's first boot")
+    parser.add_argument("--timings_file", default="timings.json", help="Where to write the per-phase timing report")
+    parser.add_argument("--prometheus_file", help="Also write the timings as a node_exporter textfile, e.g. /var/lib/node_exporter/textfile/template-creator.prom")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild every template even if one with a matching fingerprint exists")
+    parser.add_argument("--transfer_mode", choices=["cache", "stream"], default="cache", help="cache: stage images in the local image cache; stream: pipe downloads straight to the Proxmox node")
 
     args = parser.parse_args()
 
     proxmox_ip = args.proxmox_ip
-    proxmox_node = args.proxmox_node
     token_name = args.token_name
     token_secret = args.token_secret
     proxmox_user = args.user
@@ -408,6 +651,10 @@ def main():
     resource_pool = config['resource_pool']
     ensure_resource_pool(proxmox_ip, token_name, token_secret, resource_pool)
 
+    allowlist = [node.strip() for node in (args.nodes or args.proxmox_node or "").split(",") if node.strip()]
+    placer = NodePlacer(proxmox_ip, token_name, token_secret, IMPORT_STORAGE, allowlist)
+    node_addresses = get_node_addresses(proxmox_ip, token_name, token_secret)
+
     template_queue = Queue()
     for template_name, template in config['templates'].items():
         template_queue.put((template_name, template))
@@ -422,12 +669,35 @@ def main():
     ]:
         temporary_ips_queue.put(ip)
 
+    image_options = {
+        "transfer_mode": args.transfer_mode,
+        "cache_dir": config.get('image_cache_dir', 'image-cache'),
+        "cache_max_bytes": int(config.get('image_cache_max_gb', 20) * 1024 ** 3),
+        "download_connections": args.download_connections,
+        "ready_timeout": args.ready_timeout,
+        "ready_agent_ping": args.ready_agent_ping,
+        "rebuild": args.rebuild,
+        "provision_mode": args.provision_mode,
+        "compression": args.compression,
+        "scheduler": TransferScheduler(
+            {"upload": args.uploads_per_node, "import": args.imports_per_storage},
+            args.bandwidth_limit * 1024 ** 2 if args.bandwidth_limit else None
+        ),
+    }
+
+    if args.provision_mode == "snippet":
+        # Clones can end up on any node, so every node gets the snippet
+        image_options["snippet"], content = vendor_snippet()
+        for node_address in sorted(set(node_addresses.values()) or {proxmox_ip}):
+            upload_vendor_snippet(node_address, proxmox_user, proxmox_password, image_options["snippet"], content)
+
     threads = []
     for _ in range(min(concurrency, len(config['templates']))):
         thread = threading.Thread(target=thread_worker, args=(
             template_queue,
             proxmox_ip,
-            proxmox_node,
+            placer,
+            node_addresses,
             token_name,
             token_secret,
             config['resource_pool'],
@@ -438,7 +708,8 @@ def main():
             proxmox_user,
             proxmox_password,
             temporary_ips_queue,
-            template_ssh_key
+            template_ssh_key,
+            image_options
         ))
         thread.start()
         threads.append(thread)
@@ -448,5 +719,24 @@ def main():
     for thread in threads:
         thread.join()
 
+    close_ssh_clients()
+    image_options["scheduler"].report()
+    for template_name, vmid in sorted(skipped_templates.items()):
+        print(f"Skipped {template_name}: template {vmid} already matches its fingerprint")
+    for template_name, seconds in sorted(time_to_ready.items()):
+        if seconds is not None:
+            print(f"Time to ready for {template_name}: {seconds:.1f}s")
+    print_summary()
+    write_report(args.timings_file, "template-creator", {
+        "queue_waits": image_options["scheduler"].waits,
+        "time_to_ready": time_to_ready,
+        "skipped": skipped_templates,
+        "failed": failed_templates,
+    })
+    if args.prometheus_file:
+        write_prometheus(args.prometheus_file, "template-creator")
+    if failed_templates:
+        raise SystemExit(f"Failed to build {len(failed_templates)} templates: {', '.join(sorted(failed_templates))}")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
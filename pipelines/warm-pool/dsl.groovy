@@ -0,0 +1,18 @@
+pipelineJob('warm-pool') {
+    displayName('Warm Pool')
+    description('Keep pre-cloned boxes ready for the Box Builder')
+
+    definition {
+        cpsScm {
+            scm {
+                git {
+                    remote {
+                        url('https://github.com/OrangeSquirter/homelab-seed.git')
+                    }
+                    branch('master')
+                }
+            }
+            scriptPath('pipelines/warm-pool/Jenkinsfile')
+        }
+    }
+}